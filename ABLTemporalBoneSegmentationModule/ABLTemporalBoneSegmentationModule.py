@@ -1,51 +1,78 @@
+import collections
+import concurrent.futures
+import hashlib
+import importlib
 import inspect
 import json
+import logging
 import os
 import queue
 import threading
 import traceback
 import re
 import shutil
+import subprocess
 import sys
+import tempfile
+import time
 
 import ctk
 import qt
 import slicer
-import SimpleITK as sitk
-import sitkUtils as sitku
-import Elastix
-import urllib3
-import requests
-import slicer
 import vtk
 from slicer.ScriptedLoadableModule import *
 
-try:
-    import ablinfer
-except ModuleNotFoundError:
-    slicer.util.pip_install("ablinfer")
-
-from ablinfer.slicer import SlicerDispatchDocker, SlicerDispatchRemote
-from ablinfer.constants import DispatchStage
-from ablinfer.remote import DispatchRemote
-from ablinfer.base import DispatchException
-
-import docker
-import requests
-import SampleData
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+class LazyModule:
+    """Stands in for a module that is only imported when one of its attributes is first used.
+
+    :param name: The module's name.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None: self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+## Image processing (SimpleITK, sitkUtils, numpy), inference (ablinfer, docker, requests), the atlas
+## download (SampleData) and registration (Elastix) are only imported once they are first used, so
+## that they stay off Slicer's startup path
+np = LazyModule("numpy")
+sitk = LazyModule("SimpleITK")
+sitku = LazyModule("sitkUtils")
+startupBudget = 0.5
+lazyModules = ("SimpleITK", "sitkUtils", "numpy", "ablinfer", "docker", "requests", "urllib3", "SampleData", "Elastix")
+
+
+def import_ablinfer():
+    """Import ablinfer and the parts of it used here, installing it first if needed."""
+    try:
+        import ablinfer
+    except ModuleNotFoundError:
+        slicer.util.pip_install("ablinfer")
+        import ablinfer
+    import ablinfer.base
+    import ablinfer.constants
+    import ablinfer.remote
+    import ablinfer.slicer
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    return ablinfer
+
+## The values name SimpleITK interpolators, so that SimpleITK needn't be imported to list them
 supportedResampleInterpolations = [
-    {'title': 'Linear', 'value': sitk.sitkLinear},
-    {'title': 'Nearest neighbour', 'value': sitk.sitkNearestNeighbor},
-    {'title': 'B-spline', 'value': sitk.sitkBSpline},
-    {'title': 'Gaussian', 'value': sitk.sitkGaussian},
-    {'title': 'Hamming windowed sinc', 'value': sitk.sitkHammingWindowedSinc},
-    {'title': 'Blackman windowed sinc', 'value': sitk.sitkBlackmanWindowedSinc},
-    {'title': 'Cosine windowed sinc', 'value': sitk.sitkCosineWindowedSinc},
-    {'title': 'Welch windowed sinc', 'value': sitk.sitkWelchWindowedSinc},
-    {'title': 'Lanczos windowed sinc', 'value': sitk.sitkLanczosWindowedSinc}
+    {'title': 'Linear', 'value': 'sitkLinear'},
+    {'title': 'Nearest neighbour', 'value': 'sitkNearestNeighbor'},
+    {'title': 'B-spline', 'value': 'sitkBSpline'},
+    {'title': 'Gaussian', 'value': 'sitkGaussian'},
+    {'title': 'Hamming windowed sinc', 'value': 'sitkHammingWindowedSinc'},
+    {'title': 'Blackman windowed sinc', 'value': 'sitkBlackmanWindowedSinc'},
+    {'title': 'Cosine windowed sinc', 'value': 'sitkCosineWindowedSinc'},
+    {'title': 'Welch windowed sinc', 'value': 'sitkWelchWindowedSinc'},
+    {'title': 'Lanczos windowed sinc', 'value': 'sitkLanczosWindowedSinc'}
 ]
 
 supportedResamplePresets = [
@@ -53,6 +80,12 @@ supportedResamplePresets = [
     {'title': 'X:50um,  Y:50um,  Z:50um', 'value': [50, 50, 50]}
 ]
 
+atlasChecksums = {
+    "L": "SHA256:594d78fdd47b9e4e78b9edfe605eebdb11cdbb0aec690c89d2d3fe9b634a389f",
+    "R": "SHA256:258c1c140438134d15bca09c6289335248bb2a6dc415edd677fcf55f29e644a3",
+}
+atlasUrl = "https://github.com/Auditory-Biophysics-Lab/temporal-bone-segmentation/releases/download/v1.0/Atlas_%s.mha"
+
 supportedSaveTypes = [
     {'title': 'NifTI (*.nii)', 'value': '.nii'},
     {'title': 'NRRD (*.nrrd)', 'value': '.nrrd'},
@@ -137,6 +170,1316 @@ class InterfaceTools:
         return tab, table
 
 
+class LazySection:
+    """A collapsible section whose contents are built the first time it is expanded.
+
+    Widgets registered with :meth:`observe` (node selectors, markup placers) only hold the MRML scene while the section
+    is expanded, so a collapsed section doesn't react to every node added to or removed from the scene. Their current
+    node is remembered by ID across collapses.
+
+    :param title: The title of the section.
+    :param build: Called with the section's button on first expansion to fill it, or None if it is filled eagerly.
+    :param disabled: Whether the section starts disabled (and collapsed).
+    """
+    def __init__(self, title, build=None, disabled=False):
+        self.button = InterfaceTools.build_dropdown(title, disabled=disabled)
+        self.build = build
+        self.built = build is None
+        self.attached = False
+        self.observers = {}
+        self.selections = {}
+        self.button.connect('contentsCollapsed(bool)', self.toggle)
+
+    def ensure(self):
+        """Build the contents if that hasn't happened yet."""
+        if not self.built:
+            self.built = True
+            self.build(self.button)
+
+    def observe(self, name, widget):
+        """Register a scene-observing widget; it gets the scene now only if the section is expanded."""
+        self.observers[name] = widget
+        if self.attached: self.attach_widget(name, widget)
+
+    def select(self, name, node):
+        """Set the current node of an observer, or remember it for when the section is next expanded."""
+        self.selections[name] = node.GetID() if node is not None else None
+        if self.attached and name in self.observers: self.observers[name].setCurrentNode(node)
+
+    def toggle(self, collapsed):
+        if collapsed: self.detach()
+        else:
+            self.ensure()
+            self.attach()
+
+    def attach(self):
+        self.attached = True
+        for name, widget in self.observers.items(): self.attach_widget(name, widget)
+
+    def attach_widget(self, name, widget):
+        widget.setMRMLScene(slicer.mrmlScene)
+        if name in self.selections:
+            ## The node may have been removed while we weren't watching; that just leaves the widget empty
+            node_id = self.selections[name]
+            widget.setCurrentNode(slicer.mrmlScene.GetNodeByID(node_id) if node_id is not None else None)
+
+    def detach(self):
+        self.attached = False
+        for name, widget in self.observers.items():
+            node = widget.currentNode()
+            self.selections[name] = node.GetID() if node is not None else None
+            if isinstance(widget, slicer.qSlicerMarkupsPlaceWidget) and widget.placeModeEnabled: widget.setPlaceModeEnabled(False)
+            widget.setMRMLScene(None)
+
+
+# Caching
+class DiskCache:
+    """A directory of cache entries keyed by content hash, evicted least-recently-used.
+
+    Each entry is a sub-directory named after its key that may hold any number of files; an
+    entry's last use is its directory's modification time, which :meth:`get` refreshes.
+
+    :param directory: The cache's root directory, created if needed.
+    :param max_bytes: Total size beyond which the least recently used entries are evicted.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Return the entry's directory if it exists, marking it as recently used."""
+        path = self.entry_path(key)
+        if not os.path.isdir(path): return None
+        os.utime(path, None)
+        return path
+
+    def put(self, key, write):
+        """Create or replace an entry.
+
+        :param key: The entry's key.
+        :param write: Called with a fresh directory to fill with the entry's files.
+        :returns: The entry's directory, or None if the entry alone is larger than the cache, in
+                  which case nothing is stored.
+        """
+        staging = tempfile.mkdtemp(dir=self.directory, prefix='.staging-')
+        try:
+            write(staging)
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(staging) for f in files)
+            if size > self.max_bytes:
+                ## Storing it would only evict everything else and then the entry itself
+                logging.info("Not caching %s: %d bytes exceed the cache's %d" % (key, size, self.max_bytes))
+                shutil.rmtree(staging, ignore_errors=True)
+                return None
+            path = self.entry_path(key)
+            shutil.rmtree(path, ignore_errors=True)
+            os.rename(staging, path)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        self.evict()
+        return path
+
+    def entries(self):
+        """List the entries as ``(key, bytes, last_used)`` tuples, most recently used first."""
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self.entry_path(key)
+            if key.startswith('.') or not os.path.isdir(path): continue
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+            entries.append((key, size, os.path.getmtime(path)))
+        return sorted(entries, key=lambda e: e[2], reverse=True)
+
+    def size(self):
+        return sum(e[1] for e in self.entries())
+
+    def evict(self):
+        total = 0
+        for key, size, _ in self.entries():
+            total += size
+            if total > self.max_bytes: self.remove(key)
+
+    def remove(self, key):
+        shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+    def clear(self):
+        for key, _, _ in self.entries(): self.remove(key)
+
+
+class AtlasStore:
+    """Local copies of the downloaded atlases, kept as uncompressed NRRD files so that later sessions
+    neither download nor decompress them again.
+
+    Each atlas is stored with a manifest recording the checksum of the download it came from and
+    the SHA-256 of the stored file. Each file is hashed the first time it's used in a session and
+    only size-checked after that, unless it changed. Within a session the decoded images are also
+    kept in memory, so a scene reset doesn't even reread the file.
+
+    :param directory: Where to keep the atlases.
+    """
+    _images = {}
+    _verified = {}
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.nrrd')
+
+    def manifest(self, name):
+        try:
+            with open(os.path.join(self.directory, name + '.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load(self, name, checksum, verify=False):
+        """Load a stored atlas into the scene.
+
+        :param name: The atlas (and node) name.
+        :param checksum: The checksum of the expected download; a stored atlas from any other
+                         download is ignored.
+        :param verify: Whether to hash the stored file even if it was already verified this session.
+        :returns: The new volume node, or None if there is no valid stored atlas.
+        """
+        image = AtlasStore._images.get((name, checksum)) if self.in_memory(name, checksum) else None
+        if image is not None:
+            node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+            node.SetIJKToRASMatrix(image[1])
+            node.SetAndObserveImageData(image[0])
+            node.CreateDefaultDisplayNodes()
+            return node
+        if not self.is_valid(name, checksum, verify): return None
+        node = slicer.util.loadVolume(self.path(name), {"name": name})
+        self.remember(node, checksum)
+        return node
+
+    def in_memory(self, name, checksum):
+        return (name, checksum) in AtlasStore._images
+
+    def is_valid(self, name, checksum, verify=False):
+        """Whether a stored atlas from the given download exists and is intact.
+
+        The file is hashed unless it was already verified this session with the same modification
+        time and size, or ``verify`` is set.
+        """
+        manifest = self.manifest(name)
+        path = self.path(name)
+        if manifest is None or manifest.get('checksum') != checksum or not os.path.exists(path): return False
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size, manifest.get('sha256'))
+        if stat.st_size != manifest.get('bytes'):
+            logging.warning("Stored atlas %s is corrupt, ignoring it" % path)
+            return False
+        if (verify or AtlasStore._verified.get(path) != signature) and self.hash_file(path) != manifest.get('sha256'):
+            logging.warning("Stored atlas %s is corrupt, ignoring it" % path)
+            AtlasStore._verified.pop(path, None)
+            return False
+        AtlasStore._verified[path] = signature
+        return True
+
+    def put(self, node, checksum):
+        """Store an atlas that was downloaded and verified against the given checksum."""
+        os.makedirs(self.directory, exist_ok=True)
+        name = node.GetName()
+        staging = os.path.join(self.directory, name + '.part.nrrd')
+        slicer.util.saveNode(node, staging, {"useCompression": False})
+        self.commit(name, staging, checksum)
+        self.remember(node, checksum)
+
+    def put_image(self, name, image, checksum):
+        """Store an atlas given as a SimpleITK image; unlike :meth:`put`, safe to call off the main thread."""
+        os.makedirs(self.directory, exist_ok=True)
+        staging = os.path.join(self.directory, name + '.%d.part.nrrd' % threading.get_ident())
+        sitk.WriteImage(image, staging, False)
+        self.commit(name, staging, checksum)
+
+    def commit(self, name, staging, checksum):
+        path = self.path(name)
+        os.replace(staging, path)
+        stat = os.stat(path)
+        sha256 = self.hash_file(path)
+        with open(os.path.join(self.directory, name + '.json'), 'w') as f:
+            json.dump({'checksum': checksum, 'bytes': stat.st_size, 'sha256': sha256}, f)
+        ## Just hashed, so it needn't be hashed again this session
+        AtlasStore._verified[path] = (stat.st_mtime_ns, stat.st_size, sha256)
+
+    def remember(self, node, checksum):
+        matrix = vtk.vtkMatrix4x4()
+        node.GetIJKToRASMatrix(matrix)
+        AtlasStore._images[(node.GetName(), checksum)] = (node.GetImageData(), matrix)
+
+    @staticmethod
+    def hash_file(path):
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''): h.update(block)
+        return h.hexdigest()
+
+
+class AtlasPrefetch:
+    """Downloads (if needed) and decodes atlases in background threads, each once it's asked for.
+
+    Only files and SimpleITK images are touched off the main thread; turning an image into a volume
+    node is left to :meth:`ABLTemporalBoneSegmentationModuleLogic.load_atlas_and_fiducials_and_mask`.
+
+    :param store: The :class:`AtlasStore` to download into and read from.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.futures = {}
+        self.started = set()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(atlasChecksums))
+
+    def start(self, side):
+        """Start fetching a side's atlas, unless it's already being fetched or was handed over."""
+        if side in self.started: return
+        self.started.add(side)
+        self.futures[side] = self.executor.submit(self.fetch, side)
+
+    def fetch(self, side):
+        name = 'Atlas_' + side
+        checksum = atlasChecksums[side]
+        if self.store.is_valid(name, checksum): return sitk.ReadImage(self.store.path(name))
+        os.makedirs(self.store.directory, exist_ok=True)
+        download = os.path.join(self.store.directory, name + '.download.mha')
+        algorithm, digest = checksum.split(':')
+        h = hashlib.new(algorithm.lower())
+        import requests
+        with requests.get(atlasUrl % side, stream=True, timeout=60) as r:
+            r.raise_for_status()
+            with open(download, 'wb') as f:
+                for block in r.iter_content(1 << 20):
+                    h.update(block)
+                    f.write(block)
+        try:
+            if h.hexdigest() != digest.lower(): raise Exception("Checksum mismatch for the downloaded %s" % name)
+            image = sitk.ReadImage(download)
+            self.store.put_image(name, image, checksum)
+        finally:
+            os.remove(download)
+        return image
+
+    def done(self, side):
+        return side not in self.futures or self.futures[side].done()
+
+    def result(self, side):
+        """Wait for an atlas while keeping the UI responsive, then hand it over.
+
+        :returns: The atlas as a SimpleITK image, or None if it was already handed over or could not
+                  be fetched.
+        """
+        future = self.futures.pop(side, None)
+        if future is None: return None
+        while not future.done():
+            slicer.app.processEvents()
+            time.sleep(0.05)
+        try:
+            return future.result()
+        except Exception:
+            logging.warning("Prefetching the %s atlas failed:\n" % side + traceback.format_exc())
+            return None
+
+
+class RemoteClient:
+    """A pooled HTTP session for one ABLInfer server, kept for the whole Slicer session.
+
+    Every run against the server shares the session, so uploads, status polls and downloads reuse open connections
+    instead of paying TCP and TLS setup each time. Model descriptors are cached for ``ttl`` seconds. After that they
+    are fetched again, as a conditional request if the server gave an ETag so an unchanged one isn't sent again.
+
+    :param host: The server's base URL.
+    :param username: The username, if any.
+    :param password: The password, if any.
+    :param pool_size: Number of connections kept open.
+    :param ttl: Seconds a model descriptor is used without asking the server.
+    """
+    def __init__(self, host, username=None, password=None, pool_size=4, ttl=600):
+        import requests
+        import requests.adapters
+        self.host = host
+        self.credentials = (username, password) if username else None
+        self.ttl = ttl
+        self.session = requests.Session()
+        self.session.verify = False
+        if self.credentials: self.session.auth = self.credentials
+        ## Only failed connection attempts are retried; nothing has been sent for those yet
+        self.adapter = TransferAdapter(requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=2))
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.models = {}
+
+    def get_model(self, model_id):
+        """Get a model descriptor from the cache, revalidating or fetching it as needed."""
+        cached = self.models.get(model_id)
+        headers = {}
+        if cached is not None:
+            model, etag, fetched = cached
+            if time.time() - fetched < self.ttl: return model
+            if etag is not None: headers["If-None-Match"] = etag
+        r = self.session.get(self.model_url(model_id), headers=headers, timeout=30)
+        if r.status_code == 304 and cached is not None:
+            self.models[model_id] = (cached[0], cached[1], time.time())
+            return cached[0]
+        r.raise_for_status()
+        model = r.json(object_pairs_hook=collections.OrderedDict)["data"]
+        self.models[model_id] = (model, r.headers.get("ETag"), time.time())
+        return model
+
+    def model_url(self, model_id):
+        return self.host.rstrip("/") + "/models/" + model_id
+
+    def close(self):
+        self.session.close()
+
+
+class TransferAdapter:
+    """A requests transport adapter that makes large downloads resumable and measures transfer throughput.
+
+    Downloads are read in chunks. If the connection drops part way and the server supports byte ranges, the rest is
+    requested from the end of the last complete chunk rather than from the start. ``If-Range`` makes sure the resumed
+    part comes from the same file. A running SHA-256 is checked against the server's ``Digest`` header when it
+    sends one. Compressed responses (``Content-Encoding``, which requests asks for by default) are still read in
+    chunks, but restart from scratch since their byte ranges aren't stable.
+
+    Streamed downloads (``stream=True``, which is how ABLInfer fetches outputs) get the same treatment through a
+    :class:`TransferStream` in place of the response's ``raw``. Chunks already handed to the caller can't be taken
+    back, so those fail instead of restarting. Streams of unknown length, like the live run log, are passed through.
+
+    :param adapter: The ``requests.adapters.HTTPAdapter`` that does the actual sending.
+    :param chunk_size: Bytes per chunk.
+    :param retries: How many times a download may be resumed.
+    """
+    def __init__(self, adapter, chunk_size=1 << 20, retries=5):
+        self.adapter = adapter
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.transfers = collections.deque(maxlen=50)
+
+    def send(self, request, stream=False, **kwargs):
+        start = time.time()
+        if request.method != "GET":
+            ## Sized before sending, since sending reads a file body to its end
+            sent = self.body_size(request.body)
+            r = self.adapter.send(request, stream=stream, **kwargs)
+            if sent: self.record("upload", sent, time.time() - start)
+            return r
+        r = self.adapter.send(request, stream=True, **kwargs)
+        if stream:
+            if r.status_code != 200 or "Content-Length" not in r.headers: return r
+            raw = r.raw
+            r.raw = TransferStream(lambda size: self.download(self.reader(raw), r.headers, request, start, kwargs, size, False), raw)
+            return r
+        if r.status_code != 200: return self.finish(r, [r.content], None)
+        chunks = []
+        for chunk in self.download(r, r.headers, request, start, kwargs, self.chunk_size, True):
+            if chunk is None: chunks = []
+            else: chunks.append(chunk)
+        return self.finish(r, chunks, sum(len(c) for c in chunks))
+
+    def download(self, source, headers, request, start, kwargs, chunk_size, restart):
+        """Yield a download's body chunk by chunk, resuming it if the connection drops.
+
+        When a download can't be resumed it starts over if ``restart`` is set, yielding None first so the caller drops
+        what it has so far; otherwise the error is raised. The body is checked and timed once it is complete.
+
+        :param source: The response to read first.
+        :param headers: The headers of the original response.
+        """
+        import requests
+        validator = headers.get("ETag") or headers.get("Last-Modified")
+        resumable = headers.get("Accept-Ranges") == "bytes" and "Content-Encoding" not in headers and validator is not None
+        digest = hashlib.sha256()
+        received, attempts = 0, 0
+        while True:
+            try:
+                for chunk in source.iter_content(chunk_size):
+                    if not chunk: continue
+                    digest.update(chunk)
+                    received += len(chunk)
+                    yield chunk
+                break
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError) as e:
+                attempts += 1
+                if attempts > self.retries or not (resumable or restart): raise
+                retry = request.copy()
+                if resumable:
+                    logging.info("Download of %s interrupted after %.1f MB, resuming: %s" % (request.url, received/1048576.0, e))
+                    retry.headers["Range"] = "bytes=%d-" % received
+                    retry.headers["If-Range"] = validator
+                source = self.adapter.send(retry, stream=True, **kwargs)
+                if source.status_code == 206: continue
+                source.raise_for_status()
+                if source.status_code != 200 or not restart:
+                    raise requests.exceptions.ConnectionError("Could not resume the download of %s (status %d)" % (request.url, source.status_code))
+                ## Not resumable after all (or the file changed); start over
+                yield None
+                received, digest = 0, hashlib.sha256()
+        expected = headers.get("Digest", "")
+        if expected.lower().startswith("sha-256="):
+            import base64
+            if base64.b64decode(expected[8:].strip()) != digest.digest():
+                raise Exception("Checksum mismatch downloading " + request.url)
+        self.record("download", received, time.time() - start)
+
+    @staticmethod
+    def reader(raw):
+        """A response reading ``raw``, so its ``iter_content`` turns connection errors into requests' exceptions."""
+        import requests
+        r = requests.Response()
+        r.raw = raw
+        return r
+
+    @staticmethod
+    def finish(r, chunks, received):
+        r._content = b"".join(chunks)
+        r._content_consumed = True
+        if received is not None: r.headers["Content-Length"] = str(received)
+        return r
+
+    @staticmethod
+    def body_size(body):
+        if body is None: return 0
+        import requests.utils
+        try: return requests.utils.super_len(body)
+        except Exception: return 0
+
+    def record(self, direction, size, seconds):
+        self.transfers.append((direction, size, max(seconds, 1e-6)))
+
+    def throughput(self, direction):
+        """The size (bytes) and rate (bytes per second) of the latest transfer in a direction, or None."""
+        for d, size, seconds in reversed(self.transfers):
+            if d == direction: return size, size/seconds
+        return None
+
+    def close(self):
+        self.adapter.close()
+
+
+class TransferStream:
+    """Stands in for a streamed response's ``raw``, reading it through :meth:`TransferAdapter.download`.
+
+    ``Response.iter_content`` reads through :meth:`stream`; anything else (closing, releasing the connection) goes to
+    the original ``raw``.
+
+    :param download: Called with the chunk size on the first read to start the download generator.
+    :param raw: The original ``raw``.
+    """
+    def __init__(self, download, raw):
+        self.download = download
+        self.raw = raw
+        self.chunks = None
+        self.buffer = b""
+
+    def read(self, amt=None, decode_content=True, **kwargs):
+        if self.chunks is None: self.chunks = self.download(amt or (1 << 20))
+        parts, size = [self.buffer], len(self.buffer)
+        while amt is None or size < amt:
+            chunk = next(self.chunks, b"")
+            if not chunk: break
+            parts.append(chunk)
+            size += len(chunk)
+        data = b"".join(parts)
+        if amt is None: amt = len(data)
+        self.buffer = data[amt:]
+        return data[:amt]
+
+    def stream(self, amt=1 << 16, decode_content=True):
+        while True:
+            data = self.read(amt)
+            if not data: return
+            yield data
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+# Registration jobs
+class ElastixInputStore:
+    """Volumes already serialized for Elastix during this session.
+
+    Registering several volumes against the same atlas would otherwise write the same fixed image
+    and masks to disk before every run. A stored file is rewritten only if its node was modified.
+
+    :param directory: Where to keep the serialized volumes.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+
+    def get_path(self, node):
+        """Return the serialized file for the node, writing it only if needed.
+
+        :returns: A tuple of the file path and the number of bytes written (0 if it was reused).
+        """
+        stamp = (node.GetImageData().GetMTime(), node.GetMTime())
+        known = self.files.get(node.GetID())
+        if known is not None and known[0] == stamp and os.path.exists(known[1]): return known[1], 0
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, re.sub(r'\W', '_', node.GetID()) + '.mha')
+        slicer.util.saveNode(node, path, {"useCompression": False})
+        self.files[node.GetID()] = (stamp, path)
+        return path, os.path.getsize(path)
+
+    def clear(self):
+        self.files = {}
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ConvergenceMonitor:
+    """Decide from the metric values of one resolution level whether the optimizer has converged.
+
+    The adaptive stochastic gradient descent metric is noisy, so the mean over the last ``window``
+    iterations is compared with the mean over the window before it.
+
+    :param window: Number of iterations averaged on each side of the comparison.
+    :param threshold: Relative improvement below which the level counts as converged.
+    :param min_iterations: Never stop a level before this many iterations.
+    """
+    def __init__(self, window=25, threshold=1e-3, min_iterations=50):
+        self.window = window
+        self.threshold = threshold
+        self.min_iterations = max(min_iterations, 2*window)
+        self.reset()
+
+    def reset(self):
+        self.metrics = []
+
+    def add(self, metric):
+        """Record the next iteration's metric value.
+
+        :returns: True if the level has converged.
+        """
+        self.metrics.append(metric)
+        if len(self.metrics) < self.min_iterations: return False
+        previous = np.mean(self.metrics[-2*self.window:-self.window])
+        current = np.mean(self.metrics[-self.window:])
+        ## Elastix minimizes the metric
+        return (previous - current) <= self.threshold*abs(previous)
+
+    def describe(self):
+        return "window %d, threshold %g, at least %d iterations" % (self.window, self.threshold, self.min_iterations)
+
+
+class ElastixProgressParser:
+    """Follow a registration through the iteration table Elastix prints.
+
+    Every optimizer iteration is printed as a tab separated row starting with the iteration number and the metric
+    value, and each resolution level starts with a ``Resolution: n`` line. Progress is counted in iterations over all
+    levels, so it moves steadily within a level, and the time remaining is extrapolated from the iteration rate so far.
+    Every metric value is recorded for charting or export.
+
+    A level that ends early (converged, or stopped by early exit) counts as complete once the next one starts.
+
+    :param iterations: Maximum number of iterations of each level, in the order they run.
+    :param setup: Fraction of the progress reserved for reading the inputs before the first iteration.
+    :param finish: Fraction of the progress reserved for writing the results after the last iteration.
+    """
+    def __init__(self, iterations, setup=0.05, finish=0.05):
+        self.levels = [int(i) for i in iterations] or [1]
+        self.setup = setup
+        self.finish = finish
+        self.total = sum(self.levels)
+        self.level = -1
+        self.done_iterations = 0
+        self.current = 0
+        self.history = []
+        self.finished = False
+        self._started = None
+        self._iterated = 0
+
+    @staticmethod
+    def levels_from_parameters(paths):
+        """Maximum number of iterations of each resolution level run by the given parameter files, in order."""
+        levels = []
+        for path in paths:
+            parameters = ABLTemporalBoneSegmentationModuleLogic.read_elastix_parameters(path)
+            iterations = parameters.get('MaximumNumberOfIterations', [500])
+            for n in range(int(parameters.get('NumberOfResolutions', [1])[0])):
+                levels.append(int(iterations[min(n, len(iterations) - 1)]))
+        return levels
+
+    def feed(self, text):
+        """Parse one line of output.
+
+        :returns: The metric value if the line is an iteration row, otherwise None.
+        """
+        tokens = text.split('\t', 2)
+        if len(tokens) >= 2 and tokens[0].isdigit():
+            try: metric = float(tokens[1])
+            except ValueError: return None
+            now = time.monotonic()
+            if self._started is None: self._started = now
+            self.current = int(tokens[0]) + 1
+            self._iterated += 1
+            self.history.append((max(self.level, 0), int(tokens[0]), metric, now - self._started))
+            return metric
+        if text.startswith('Resolution:'):
+            if self.level >= 0: self.done_iterations += self.levels[min(self.level, len(self.levels) - 1)]
+            self.level += 1
+            self.current = 0
+        elif text.startswith('Registration is completed'):
+            self.finished = True
+        return None
+
+    def progress(self):
+        """Fraction of the registration done, between 0 and 1."""
+        if self.finished: return 1.0
+        if self.level < 0: return 0.0
+        done = min(self.total, self.done_iterations + min(self.current, self.levels[min(self.level, len(self.levels) - 1)]))
+        return self.setup + (1 - self.setup - self.finish)*done/self.total
+
+    def eta(self):
+        """Estimated seconds until the last iteration, or None before there is a rate to go on."""
+        if self.finished: return 0.0
+        if self._iterated < 10: return None
+        rate = self._iterated/(time.monotonic() - self._started)
+        remaining = self.total - self.done_iterations - self.current
+        return max(0.0, remaining/rate) if rate > 0 else None
+
+    def write_csv(self, path):
+        """Write the metric history as CSV with the columns level, iteration, metric and seconds."""
+        with open(path, 'w') as f:
+            f.write('level,iteration,metric,seconds\n')
+            for level, iteration, metric, seconds in self.history:
+                f.write('%d,%d,%r,%.3f\n' % (level, iteration, metric, seconds))
+
+    @staticmethod
+    def format_eta(seconds):
+        if seconds is None: return ''
+        return '%d:%02d left' % divmod(int(round(seconds)), 60)
+
+
+class TransformChain:
+    """Registration transforms of a volume, composed as a transform hierarchy instead of being
+    hardened after every step.
+
+    The chained volume shares its voxels with the original, so no step copies them. Registration
+    steps that need the transformed volume as input get a :meth:`proxy` with the composed geometry,
+    and the chain is only hardened when the volume is saved, cropped or used for inference (see
+    :meth:`ABLTemporalBoneSegmentationModuleLogic.harden_transforms`). Each chain counts the
+    transforms composed into it; hardening linear transforms only changes the volume's geometry, so
+    they never cost a resample.
+    """
+    def __init__(self, node, name=None):
+        self.source = node
+        self.node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name or node.GetName())
+        self.node.SetIJKToRASMatrix(TransformChain.world_ijk_to_ras(node))
+        self.node.SetAndObserveImageData(node.GetImageData())
+        self.node.CreateDefaultDisplayNodes()
+        self.transforms = []
+        self.composed = 0
+        self._proxy = None
+
+    def append(self, transform_node, suffix=''):
+        """Apply a transform after the ones already in the chain."""
+        if not transform_node.IsTransformToWorldLinear(): raise ValueError("Only linear transforms can be chained")
+        self.remove_proxy()
+        ## A node's parent transform is applied after the node's own, so the newest is the root
+        (self.transforms[-1] if self.transforms else self.node).SetAndObserveTransformNodeID(transform_node.GetID())
+        self.transforms.append(transform_node)
+        self.node.SetName(self.node.GetName() + suffix)
+        self.composed += 1
+
+    def proxy(self):
+        """A volume with the chain's composed geometry that shares the voxels, for use as the input of
+        the next registration step."""
+        if self.node.GetParentTransformNode() is None: return self.node
+        if self._proxy is None:
+            self._proxy = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', self.node.GetName())
+            self._proxy.SetIJKToRASMatrix(TransformChain.world_ijk_to_ras(self.node))
+            self._proxy.SetAndObserveImageData(self.node.GetImageData())
+            self._proxy.HideFromEditorsOn()
+        return self._proxy
+
+    @staticmethod
+    def world_ijk_to_ras(node):
+        """The IJK to RAS matrix a volume would have after hardening its linear transforms."""
+        ijk_to_ras = vtk.vtkMatrix4x4()
+        node.GetIJKToRASMatrix(ijk_to_ras)
+        if node.GetParentTransformNode() is not None:
+            to_world = vtk.vtkMatrix4x4()
+            node.GetParentTransformNode().GetMatrixTransformToWorld(to_world)
+            world = vtk.vtkMatrix4x4()
+            vtk.vtkMatrix4x4.Multiply4x4(to_world, ijk_to_ras, world)
+            return world
+        return ijk_to_ras
+
+    def remove_proxy(self):
+        if self._proxy is not None: slicer.mrmlScene.RemoveNode(self._proxy)
+        self._proxy = None
+
+    def describe(self):
+        return "%d transform(s) composed into %s, %d resample(s) when hardened" % (
+            self.composed, self.node.GetName(), ABLTemporalBoneSegmentationModuleLogic.count_resamples(self.node))
+
+
+
+class ProgressBus:
+    """Coalesces progress updates into a fixed refresh rate.
+
+    Registration and inference report progress once per output line, which can be thousands of times per run;
+    repainting for each of them slows the work being reported on. Posted lines are kept in a ring buffer holding the
+    full log, keyword state is merged so only its latest value is kept, and ``refresh`` is called at most ``rate``
+    times a second with everything posted since the previous refresh.
+
+    :param refresh: Called as ``refresh(lines, state)`` with the new lines and the merged state.
+    :param rate: Maximum number of refreshes per second.
+    :param capacity: Number of log lines kept.
+    :param echo: Print the new lines on each refresh, in one batch.
+    :param pump: Process Qt events after each refresh, for callers that block the event loop while posting.
+    """
+    def __init__(self, refresh, rate=10, capacity=10000, echo=False, pump=False):
+        self.refresh = refresh
+        self.interval = 1.0 / rate
+        self.log = collections.deque(maxlen=capacity)
+        self.echo = echo
+        self.pump = pump
+        self._lines = []
+        self._state = {}
+        self._last = 0
+        self.timer = qt.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.connect('timeout()', self.flush)
+
+    def post(self, text=None, **state):
+        """Queue a log line and/or state update, refreshing now only if the last refresh is old enough."""
+        if text is not None:
+            self.log.append(text)
+            self._lines.append(text)
+        self._state.update(state)
+        wait = self._last + self.interval - time.monotonic()
+        if wait <= 0: self.flush()
+        ## Make sure the last update of a burst still gets shown
+        elif not self.timer.isActive(): self.timer.start(int(wait * 1000) + 1)
+
+    def flush(self):
+        """Refresh immediately with everything posted so far."""
+        self.timer.stop()
+        if not self._lines and not self._state: return
+        lines, state = self._lines, self._state
+        self._lines, self._state = [], {}
+        self._last = time.monotonic()
+        if self.echo and lines: print('\n'.join(lines))
+        self.refresh(lines, state)
+        if self.pump: slicer.app.processEvents()
+
+    def history(self):
+        """The most recent ``capacity`` lines posted, oldest first."""
+        return '\n'.join(self.log)
+
+
+class InferenceJob:
+    """A prepared inference run waiting in an :class:`InferenceQueue`.
+
+    :param input_node: The (hardened) volume to segment.
+    :param config: The dispatch configuration, see :meth:`ABLTemporalBoneSegmentationModuleLogic.build_inference_config`.
+    :param dispatch: The dispatch class.
+    :param model: The model description.
+    :param model_config: The model configuration; its output values are filled in by the run.
+    """
+    def __init__(self, input_node, config, dispatch, model, model_config):
+        self.input_node = input_node
+        self.name = input_node.GetName()
+        self.config = config
+        self.dispatch = dispatch
+        self.model = model
+        self.model_config = model_config
+        self.status = JobStatus.PENDING
+        self.error = None
+        self.traceback = None
+        self.elapsed = None
+        self.startup = None
+        self.image_ready = None
+
+    def target(self):
+        """Where the job is dispatched to: the remote server, or the Docker daemon."""
+        return self.config.get("base_url") or (self.config.get("docker") or {}).get("base_url") or "docker"
+
+
+class InferenceQueue:
+    """Runs inference jobs one after another, starting each as soon as the previous one finishes.
+
+    Jobs are started from a timer on the main thread, as ABLInfer's Slicer dispatches save and load MRML nodes. A
+    run pumps the event loop through its progress callback (see :class:`ProgressBus`), so while the model computes the
+    user can keep working (placing fiducials, running the rigid registration) and queue further runs; each is
+    dispatched the moment the model is free. Any handler the user triggers meanwhile runs in the middle of the
+    dispatch, so ``on_started`` should disable the controls whose handlers replace or remove volumes, and
+    ``on_finished`` enable them again.
+
+    :param progress: Called with the ABLInfer progress arguments of the running job.
+    :param on_started: Called with each job as it starts.
+    :param on_finished: Called with each job once it completed or failed.
+
+    Each job's startup latency, from dispatch to the model's first inference iteration, is recorded. A Docker run is
+    labelled "image ready" if its daemon's :class:`DockerWarmup` had finished before the run was dispatched, and "image
+    not ready" otherwise; either way a new container is started for it. Remote runs have no warmup and aren't labelled.
+    """
+    pollInterval = 200
+
+    def __init__(self, progress=None, on_started=None, on_finished=None):
+        self.jobs = collections.deque()
+        self.current = None
+        self.finished = []
+        self._start = None
+        self.progress = progress or (lambda *args: None)
+        self.on_started = on_started
+        self.on_finished = on_finished
+        self.closed = False
+        self.timer = qt.QTimer()
+        self.timer.setInterval(self.pollInterval)
+        self.timer.connect('timeout()', self.poll)
+
+    def put(self, job):
+        """Queue a job.
+
+        :returns: The number of jobs that will run before it.
+        """
+        ahead = len(self)
+        self.jobs.append(job)
+        ## A running job restarts the timer once it's done
+        if self.current is None: self.timer.start()
+        return ahead
+
+    def __len__(self):
+        return len(self.jobs) + (1 if self.current is not None else 0)
+
+    def poll(self):
+        if self.current is not None: return
+        ## Nothing may start from the event loops pumped by this job, or by the dialogs that report its result
+        self.timer.stop()
+        if len(self.jobs) == 0: return
+        job = self.current = self.jobs.popleft()
+        job.status = JobStatus.RUNNING
+        if job.config.get("base_url") is None:
+            warmup = ABLTemporalBoneSegmentationModuleLogic._dockerWarmups.get((job.config.get("docker") or {}).get("base_url") or "")
+            job.image_ready = warmup is not None and warmup.ready()
+        if self.on_started is not None: self.on_started(job)
+        self._start = time.time()
+        try:
+            ABLTemporalBoneSegmentationModuleLogic.run_inference(job.config, job.model, job.model_config, dispatch=job.dispatch,
+                                                                 progress=self._progress, get_model=True)
+            job.status = JobStatus.COMPLETE
+        except Exception as e:
+            job.status = JobStatus.FAILED
+            job.error = e
+            job.traceback = traceback.format_exc()
+        finally:
+            job.elapsed = time.time() - self._start
+            self.current = None
+        self.finished.append(job)
+        if self.on_finished is not None and not self.closed: self.on_finished(job)
+        if self.jobs: self.timer.start()
+
+    def _progress(self, stage, f1, f2, text):
+        job = self.current
+        if job is not None and job.startup is None and "inference iter" in text: job.startup = time.time() - self._start
+        if not self.closed: self.progress(stage, f1, f2, text)
+
+    def describe_latency(self, target=None):
+        """Summarize the startup latencies measured so far by whether the image was ready, optionally for one dispatch
+        target."""
+        jobs = [j for j in self.finished if j.startup is not None and (target is None or j.target() == target)]
+        parts = []
+        for label, ready in (("image not ready", False), ("image ready", True), ("remote", None)):
+            times = [j.startup for j in jobs if j.image_ready is ready]
+            if times: parts.append("%s %.1f s (mean of %d)" % (label, sum(times)/len(times), len(times)))
+        return ", ".join(parts)
+
+    def clear(self):
+        """Drop every job that hasn't started yet."""
+        for job in self.jobs: job.status = JobStatus.CANCELLED
+        self.jobs.clear()
+
+    def close(self):
+        """Drop the queued jobs and stop reporting on the running one, whose callbacks' widgets are going away."""
+        self.clear()
+        self.timer.stop()
+        self.closed = True
+
+
+class DockerWarmup:
+    """Gets a Docker daemon ready to run the model while the user is still preparing the scan.
+
+    In a background thread this connects to the daemon and, unless the model's image is already local, pulls it, so the
+    first inference of the session doesn't spend its startup downloading the image. Each inference still starts its own
+    container. The daemon connection is kept for the session and closed by :meth:`close`, which also stops a pull.
+
+    :param model: The model description; its ``docker`` entry names the image.
+    :param docker_host: The Docker daemon location; the environment default is used if empty.
+    """
+    def __init__(self, model, docker_host=None):
+        docker = model.get("docker") or {}
+        self.image = docker.get("image_name")
+        self.tag = docker.get("image_tag") or "latest"
+        self.docker_host = docker_host
+        self.client = None
+        self.seconds = None
+        self.closing = False
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.future = executor.submit(self.warm)
+        self.future.add_done_callback(lambda f: f.exception() and logging.warning("Warming up Docker failed: %s" % f.exception()))
+        executor.shutdown(wait=False)
+
+    def warm(self):
+        import docker
+        start = time.time()
+        try:
+            self.client = docker.DockerClient(base_url=self.docker_host) if self.docker_host else docker.from_env()
+            self.client.ping()
+            if self.image:
+                try:
+                    self.client.images.get("%s:%s" % (self.image, self.tag))
+                except docker.errors.ImageNotFound:
+                    logging.info("Pulling %s:%s for inference" % (self.image, self.tag))
+                    ## Streamed, so that closing can stop it between progress messages
+                    for line in self.client.api.pull(self.image, tag=self.tag, stream=True, decode=True):
+                        if "error" in line: raise Exception(line["error"])
+                        if self.closing:
+                            logging.info("Stopped pulling %s:%s" % (self.image, self.tag))
+                            return None
+            self.seconds = time.time() - start
+            return self.seconds
+        finally:
+            if self.closing: self.close_client()
+
+    def ready(self):
+        """Whether the image is ready, i.e. the warmup finished successfully."""
+        return self.future.done() and self.future.exception() is None and self.seconds is not None
+
+    def close(self, timeout=10):
+        """Stop a running pull and close the daemon connection.
+
+        :param timeout: Seconds to wait for the pull to stop; if it doesn't, its thread closes the connection once it
+                        does.
+        """
+        self.closing = True
+        concurrent.futures.wait([self.future], timeout=timeout)
+        if self.future.done(): self.close_client()
+
+    def close_client(self):
+        client, self.client = self.client, None
+        if client is not None: client.close()
+
+
+class JobStatus:
+    PENDING = 1
+    RUNNING = 2
+    COMPLETE = 3
+    FAILED = 4
+    CANCELLED = 5
+
+
+class ElastixRegistrationJob:
+    """A single Elastix registration running as a separate background process.
+
+    Writing the inputs and loading the resulting transform touch the MRML scene, so they happen on
+    the main thread in :meth:`start` and :meth:`poll`; only the Elastix process itself (and a
+    thread draining its output) runs in the background. Each job gets its own temporary directory,
+    so several jobs may run at the same time.
+
+    :param elastix: The ``Elastix.ElastixLogic`` used to locate the Elastix executable.
+    :param fixed_node: The fixed volume node.
+    :param moving_node: The moving volume node.
+    :param parameter_filenames: Parameter file names, relative to ``parameter_files_dir``.
+    :param fixed_mask_node: Optional fixed mask volume node.
+    :param moving_mask_node: Optional moving mask volume node.
+    :param log_callback: Called on the main thread with each line of Elastix output.
+    :param threads: Maximum number of threads the Elastix process may use; all cores if None.
+    :param parameter_files_dir: Directory holding the parameter files; defaults to this module's.
+    :param cache: Optional :class:`DiskCache` of previously computed transforms; a hit skips Elastix.
+    :param transform_only: Only the transform is used, so stop Elastix from resampling and writing
+                           the result image.
+    :param input_store: Optional :class:`ElastixInputStore` through which the fixed volume and masks
+                        are serialized, so they are only written once per session.
+    :param convergence: Optional :class:`ConvergenceMonitor`. Each resolution level is then run on
+                        its own, and stopped as soon as the monitor reports that its metric has
+                        converged; the last transform written by that level is kept.
+    """
+    def __init__(self, elastix, fixed_node, moving_node, parameter_filenames, fixed_mask_node=None,
+                 moving_mask_node=None, log_callback=None, threads=None, parameter_files_dir=None, cache=None,
+                 transform_only=True, input_store=None, convergence=None):
+        self.elastix = elastix
+        self.fixed_node = fixed_node
+        self.moving_node = moving_node
+        self.parameter_filenames = list(parameter_filenames)
+        self.fixed_mask_node = fixed_mask_node
+        self.moving_mask_node = moving_mask_node
+        self.log_callback = log_callback
+        self.threads = threads
+        self.parameter_files_dir = parameter_files_dir or ABLTemporalBoneSegmentationModuleLogic.get_parameter_files_dir()
+        self.cache = cache
+        self.transform_only = transform_only
+        self.input_store = input_store
+        self.convergence = convergence
+        self.stages = []
+        self.results = []
+        self.max_iterations = []
+        self.iterations = []
+        self._converged = False
+        self.parser = None
+        self.bytes_written = 0
+        self.bytes_reused = 0
+        self.cache_key = None
+        self.cached = False
+
+        self.status = JobStatus.PENDING
+        self.error = None
+        self.progress = 0
+        self.transform_node = None
+        self.temp_dir = None
+        self.process = None
+        self._lines = queue.Queue()
+        self._reader = None
+
+    def start(self):
+        if self.cache is not None:
+            self.cache_key = self.compute_cache_key()
+            entry = self.cache.get(self.cache_key)
+            if entry is not None:
+                with open(os.path.join(entry, 'transform.json'), 'r') as f:
+                    matrix = np.array(json.load(f)['matrix'])
+                self.transform_node = ABLTemporalBoneSegmentationModuleLogic.matrix_to_transform_node(matrix, self.moving_node.GetName() + ' Elastix transform')
+                self.cached = True
+                self.status = JobStatus.COMPLETE
+                self.progress = 100
+                self._log('Using cached transform ' + self.cache_key[:12])
+                self._log('Registration is completed')
+                return self
+
+        self.temp_dir = tempfile.mkdtemp(dir=self.elastix.getTempDirectoryBase())
+        input_dir = os.path.join(self.temp_dir, 'input')
+        os.makedirs(input_dir)
+
+        paths = {}
+        inputs = [
+            (self.fixed_node, 'fixed.mha', '-f', True),
+            (self.moving_node, 'moving.mha', '-m', False),
+            (self.fixed_mask_node, 'fixedMask.mha', '-fMask', True),
+            (self.moving_mask_node, 'movingMask.mha', '-mMask', True),
+        ]
+        for node, filename, flag, shared in inputs:
+            if node is None: continue
+            if shared and self.input_store is not None:
+                path, written = self.input_store.get_path(node)
+                if written == 0: self.bytes_reused += os.path.getsize(path)
+            else:
+                path = os.path.join(input_dir, filename)
+                slicer.util.saveNode(node, path, {"useCompression": False})
+                written = os.path.getsize(path)
+            self.bytes_written += written
+            paths[flag] = path
+        self._log('Wrote %.1f MB of input images (reused %.1f MB already on disk)' % (self.bytes_written/1048576.0, self.bytes_reused/1048576.0))
+
+        overrides = {'WriteResultImage': 'false'} if self.transform_only else {}
+        if self.convergence is None:
+            args = [a for flag, path in paths.items() for a in (flag, path)]
+            for filename in self.parameter_filenames:
+                path = os.path.join(self.parameter_files_dir, filename)
+                if overrides:
+                    ## The result image would only be written to disk and never read back
+                    path = ABLTemporalBoneSegmentationModuleLogic.write_elastix_parameters(path, os.path.join(input_dir, filename), overrides)
+                args += ['-p', path]
+            self.stages.append(args)
+            levels = ElastixProgressParser.levels_from_parameters([os.path.join(self.parameter_files_dir, f) for f in self.parameter_filenames])
+        else:
+            ## One single-resolution run per level, so that each can be stopped on its own; Elastix
+            ## still downsamples both images to the level's factor
+            if len(self.parameter_filenames) != 1: raise ValueError("Per-level registration needs exactly one parameter file")
+            source = os.path.join(self.parameter_files_dir, self.parameter_filenames[0])
+            iterations = ABLTemporalBoneSegmentationModuleLogic.read_elastix_parameters(source).get('MaximumNumberOfIterations', [500])
+            args = [a for flag, path in paths.items() for a in (flag, path)]
+            for n, factor in enumerate(ABLTemporalBoneSegmentationModuleLogic.get_pyramid_factors(source)):
+                self.max_iterations.append(int(iterations[min(n, len(iterations) - 1)]))
+                level_overrides = dict(overrides, **{
+                    'NumberOfResolutions': 1,
+                    'FixedImagePyramidSchedule': [factor]*3,
+                    'MovingImagePyramidSchedule': [factor]*3,
+                    'AutomaticTransformInitialization': 'true' if n == 0 else 'false',
+                    'MaximumNumberOfIterations': self.max_iterations[-1],
+                    ## Lets a level that is stopped early still hand on its latest transform
+                    'WriteTransformParametersEachIteration': 'true',
+                })
+                path = os.path.join(input_dir, 'Level%d_%s' % (n, self.parameter_filenames[0]))
+                self.stages.append(args + ['-p', ABLTemporalBoneSegmentationModuleLogic.write_elastix_parameters(source, path, level_overrides)])
+            levels = self.max_iterations
+
+        self.parser = ElastixProgressParser(levels)
+        self.status = JobStatus.RUNNING
+        self._start_stage()
+        return self
+
+    def _start_stage(self):
+        n = len(self.results)
+        self._converged = False
+        self.iterations.append(0)
+        if self.convergence is not None: self.convergence.reset()
+        result_dir = os.path.join(self.temp_dir, 'result-transform-%d' % n)
+        os.makedirs(result_dir)
+        args = self.stages[n] + ['-out', result_dir]
+        if n > 0: args += ['-t0', self.results[-1]]
+        if self.threads is not None: args += ['-threads', str(self.threads)]
+        self.results.append(os.path.join(result_dir, 'TransformParameters.%d.txt' % (len(self.parameter_filenames) - 1)))
+
+        executable = os.path.join(self.elastix.getElastixBinDir(), self.elastix.elastixFilename)
+        kwargs = {}
+        if sys.platform == 'win32': kwargs['startupinfo'] = self.elastix.getStartupInfo()
+        if len(self.stages) > 1: self._log('Pyramid level %d of %d' % (n + 1, len(self.stages)))
+        self._log('Register volumes in working directory: ' + result_dir)
+        self.process = subprocess.Popen([executable] + args, env=self.elastix.getElastixEnv(), stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT, universal_newlines=True, **kwargs)
+        self._reader = threading.Thread(target=self._read_output, daemon=True)
+        self._reader.start()
+
+    def compute_cache_key(self):
+        """Hash everything the registration result depends on: the voxels and geometry of every
+        input volume and the contents of the parameter files."""
+        h = hashlib.sha256()
+        for node in (self.fixed_node, self.moving_node, self.fixed_mask_node, self.moving_mask_node):
+            h.update(ABLTemporalBoneSegmentationModuleLogic.hash_volume(node).encode() if node is not None else b'-')
+        for filename in self.parameter_filenames:
+            with open(os.path.join(self.parameter_files_dir, filename), 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        if self.convergence is not None: h.update(self.convergence.describe().encode())
+        return h.hexdigest()
+
+    def _read_output(self):
+        for line in iter(self.process.stdout.readline, ''):
+            self._lines.put(line.rstrip())
+        self.process.stdout.close()
+
+    def _track_iteration(self, text):
+        metric = self.parser.feed(text)
+        if metric is None: return
+        self.iterations[-1] = self.parser.current
+        if self.convergence is not None and not self._converged and self.convergence.add(metric):
+            self._converged = True
+
+    def _finish_early_stage(self):
+        """Replace the killed level's result with the last transform it wrote."""
+        path = ElastixRegistrationJob.last_complete_transform(os.path.dirname(self.results[-1]))
+        if path is None: raise Exception("Elastix was stopped before writing a transform")
+        self.results[-1] = path
+        n = len(self.results)
+        done = int(re.search(r'It(\d+)', os.path.basename(path)).group(1)) + 1
+        self._log('Level %d converged after %d of %d iterations (%d saved)' % (n, done, self.max_iterations[n - 1], self.max_iterations[n - 1] - done))
+
+    @staticmethod
+    def last_complete_transform(result_dir):
+        """The newest per-iteration transform Elastix finished writing, or None.
+
+        Elastix writes these files one after the other, so all but the newest are complete. The newest may have been
+        cut short when the process was killed, so it is only used if it's the only one and it parses completely.
+        """
+        written = sorted(f for f in os.listdir(result_dir) if re.match(r'TransformParameters\.\d+\.R\d+\.It\d+\.txt$', f))
+        if len(written) > 1: return os.path.join(result_dir, written[-2])
+        if not written: return None
+        path = os.path.join(result_dir, written[0])
+        try:
+            p = ABLTemporalBoneSegmentationModuleLogic.read_elastix_parameters(path)
+            complete = len(p['TransformParameters']) == int(p['NumberOfParameters'][0])
+            complete = complete and (p['Transform'][0] == 'TranslationTransform' or 'CenterOfRotationPoint' in p)
+        except (IOError, KeyError, IndexError, ValueError):
+            complete = False
+        return path if complete else None
+
+    def eta(self):
+        """Estimated seconds until the registration finishes, or None if unknown."""
+        if self.status == JobStatus.COMPLETE: return 0.0
+        return self.parser.eta() if self.parser is not None else None
+
+    def iterations_saved(self):
+        """Number of iterations skipped by early stopping, per level run so far."""
+        return [max(0, m - i) for m, i in zip(self.max_iterations, self.iterations)]
+
+    def _log(self, text):
+        if self.parser is not None:
+            self._track_iteration(text)
+            self.progress = int(100*self.parser.progress())
+        if self.log_callback is not None: self.log_callback(text)
+
+    def _drain(self):
+        while True:
+            try: line = self._lines.get_nowait()
+            except queue.Empty: break
+            self._log(line)
+
+    def is_running(self):
+        return self.status in (JobStatus.PENDING, JobStatus.RUNNING)
+
+    def wait(self, interval=0.1):
+        """Block until the job finishes, without running the Qt event loop.
+
+        :returns: The transform node produced by the registration.
+        """
+        while self.poll(): time.sleep(interval)
+        if self.status != JobStatus.COMPLETE: raise Exception(self.error or "Elastix registration cancelled")
+        return self.transform_node
+
+    def poll(self):
+        """Forward pending output and finish the job if the process has exited.
+
+        Must be called from the main thread.
+
+        :returns: True while the job is still running.
+        """
+        if self.status != JobStatus.RUNNING: return self.is_running()
+        self._drain()
+        if self._converged and self.process.poll() is None: self.process.kill()
+        if self.process.poll() is None: return True
+        self._reader.join()
+        self._drain()
+        stopped = self._converged and self.process.returncode != 0
+        if stopped:
+            try: self._finish_early_stage()
+            except Exception as e: stopped = False; self._log('Error: {0}'.format(e))
+        if (self.process.returncode == 0 or stopped) and len(self.results) < len(self.stages):
+            ## Next pyramid level, initialized from this one's transform
+            self._start_stage()
+            return True
+        try:
+            if self.process.returncode != 0 and not stopped:
+                raise subprocess.CalledProcessError(self.process.returncode, "elastix")
+            if self.convergence is not None:
+                self._log('Early stopping saved %d of %d iterations' % (sum(self.iterations_saved()), sum(self.max_iterations)))
+            matrix = ABLTemporalBoneSegmentationModuleLogic.elastix_parameters_to_matrix(self.results[-1])
+            self.transform_node = ABLTemporalBoneSegmentationModuleLogic.matrix_to_transform_node(matrix, self.moving_node.GetName() + ' Elastix transform')
+            if self.cache is not None:
+                def write(directory):
+                    with open(os.path.join(directory, 'transform.json'), 'w') as f:
+                        json.dump({'matrix': matrix.tolist(), 'moving': self.moving_node.GetName(), 'parameters': self.parameter_filenames}, f)
+                self.cache.put(self.cache_key, write)
+            self.status = JobStatus.COMPLETE
+            self._log('Registration is completed')
+            self.progress = 100
+        except Exception as e:
+            self.status = JobStatus.FAILED
+            self.error = e
+            self._log('Error: {0}'.format(e))
+        finally:
+            self.cleanup()
+        return False
+
+    def cancel(self):
+        """Terminate the Elastix process immediately."""
+        if not self.is_running(): return
+        self.status = JobStatus.CANCELLED
+        if self.process is not None:
+            if self.process.poll() is None: self.process.kill()
+            self.process.wait()
+            self._reader.join()
+        self.cleanup()
+        self._log('Registration cancelled')
+
+    def cleanup(self):
+        if self.temp_dir is not None and self.elastix.deleteTemporaryFiles:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+
 # User Interface Build
 class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
     # Data members --------------
@@ -148,8 +1491,10 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
     fiducialSet = []
     intermediateNode = None
     sectionsList = []
-    elastixLogic = Elastix.ElastixLogic()
+    sections = {}
+    elastixLogic = None
     roiNode = None
+    loadingAtlas = False
 
     # UI members -------------- (in order of appearance)
     clearMarkupsCheckbox = None
@@ -166,6 +1511,7 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
     resampleSpacingYBox = None
     resampleSpacingZBox = None
     resampleInterpolation = None
+    resampleRoiSelector = None
     resampleButton = None
     fiducialPlacer = None
     fiducialTabs = None
@@ -178,6 +1524,14 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
     rigidProgress = None
     rigidApplyButton = None
     rigidCancelButton = None
+    rigidJob = None
+    rigidTimer = None
+    rigidProgressBus = None
+    rigidCacheCheckbox = None
+    rigidEarlyExitCheckbox = None
+    rigidDeferCheckbox = None
+    rigidCacheLabel = None
+    rigidCacheClearButton = None
 
     isCropping = False
     cropStartButton = False
@@ -194,6 +1548,9 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
     inferRunWidget = None
     inferProgressMajor = None
     inferProgressMinor = None
+    inferProgressBus = None
+    inferQueue = None
+    inferQueueLabel = None
     inferApplyButton = None
     inferGoodVolume = None
     _infer_last_run_progress = 0
@@ -218,9 +1575,7 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.init_rigid_registration()
         self.init_crop_and_transform()
         self.init_infer_tools()
-        self.init_render_tools()
-        self.init_export_tools()
-        self.init_resample_tools()
+        ## Rendering, export and resample tools are only built once their section is first expanded
 
     def init_volume_tools(self):
         self.clearMarkupsCheckbox = qt.QCheckBox("Clear All Markups When Loading New Input Volume")
@@ -273,6 +1628,12 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.resampleInterpolation = qt.QComboBox()
         for i in supportedResampleInterpolations: self.resampleInterpolation.addItem(i["title"])
         self.resampleInterpolation.currentIndex = 2
+        self.resampleRoiSelector = slicer.qMRMLNodeComboBox()
+        self.resampleRoiSelector.nodeTypes = ["vtkMRMLAnnotationROINode"]
+        self.resampleRoiSelector.noneEnabled = True
+        self.resampleRoiSelector.addEnabled = False
+        self.resampleRoiSelector.removeEnabled = False
+        self.resampleRoiSelector.setToolTip("Only resample the part of the volume inside this ROI, which is much faster than resampling everything and cropping afterwards.")
         self.resampleButton = qt.QPushButton("Resample Output to New Volume")
         self.resampleButton.setFixedHeight(24)
         self.resampleButton.connect('clicked(bool)', self.click_resample_volume)
@@ -296,7 +1657,6 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.fiducialPlacer = slicer.qSlicerMarkupsPlaceWidget()
         self.fiducialPlacer.buttonsVisible = False
         self.fiducialPlacer.placeMultipleMarkups = slicer.qSlicerMarkupsPlaceWidget.ForcePlaceSingleMarkup
-        self.fiducialPlacer.setMRMLScene(slicer.mrmlScene)
         self.fiducialPlacer.placeButton().show()
         self.fiducialPlacer.connect('activeMarkupsFiducialPlaceModeChanged(bool)', self.click_fiducial_placement)
 
@@ -315,6 +1675,21 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.rigidCancelButton.connect('clicked(bool)', self.click_rigid_cancel)
         self.rigidApplyButton = qt.QPushButton("Apply\n Rigid Registration")
         self.rigidApplyButton.connect('clicked(bool)', self.click_rigid_apply)
+        self.rigidCacheCheckbox = qt.QCheckBox("Reuse cached transforms")
+        self.rigidCacheCheckbox.checked = True
+        self.rigidCacheCheckbox.setToolTip("Reuse the stored result if this exact volume was already registered with the same mask and parameters.")
+        self.rigidCacheLabel = qt.QLabel()
+        self.rigidEarlyExitCheckbox = qt.QCheckBox("Stop each resolution early once converged")
+        self.rigidDeferCheckbox = qt.QCheckBox("Apply transform when cropping")
+        self.rigidDeferCheckbox.setToolTip("Leave the registration transform unhardened and apply it together with the ROI crop in Step 3, so the volume is only interpolated once and never copied in full.")
+        self.rigidEarlyExitCheckbox.setToolTip("Stop a resolution level as soon as the metric stops improving instead of running all of its iterations. Useful after a good fiducial registration.")
+        self.rigidCacheClearButton = qt.QPushButton("Clear Cache")
+        self.rigidCacheClearButton.setFixedWidth(90)
+        self.rigidCacheClearButton.connect('clicked(bool)', self.click_rigid_clear_cache)
+        self.rigidTimer = qt.QTimer()
+        self.rigidTimer.setInterval(200)
+        self.rigidTimer.connect('timeout()', self.poll_rigid_registration)
+        self.rigidProgressBus = ProgressBus(self.refresh_rigid_progress, echo=True)
 
     def init_crop_and_transform(self):
         self.cropStartButton = qt.QPushButton("Choose ROI")
@@ -338,6 +1713,10 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.inferProgressMinor.maximum = 100
         self.inferProgressMinor.value = 0
         self.inferProgressMinor.setFormat("Current Step: %p%")
+        ## Inference blocks the event loop while it reports progress, so the bus has to pump it
+        self.inferProgressBus = ProgressBus(self.refresh_infer_progress, echo=True, pump=True)
+        self.inferQueue = InferenceQueue(progress=self._infer_progress, on_started=self.start_inference, on_finished=self.finish_inference)
+        self.inferQueueLabel = qt.QLabel()
 
         self.inferRunWidget = qt.QWidget()
 
@@ -399,7 +1778,6 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
     def init_export_tools(self):
         self.exportSelector = slicer.qMRMLNodeComboBox()
         self.exportSelector.nodeTypes = ["vtkMRMLSegmentationNode"]
-        self.exportSelector.setMRMLScene(slicer.mrmlScene)
         self.exportSelector.addEnabled = False
         self.exportSelector.renameEnabled = True
         self.exportSelector.noneEnabled = False
@@ -412,17 +1790,28 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
     # UI build ------------------------------------------------------------------------------
     def setup(self):
         ScriptedLoadableModuleWidget.setup(self)
+        self.sections = {}
         self.sectionsList.append(self.build_volume_tools())
         self.sectionsList.append(self.build_fiducial_registration())
         self.sectionsList.append(self.build_rigid_registration())
         self.sectionsList.append(self.build_crop_tools())
         self.sectionsList.append(self.build_infer_tools())
-        self.sectionsList.append(self.build_render_tools())
-        self.sectionsList.append(self.build_export_tools())
-        self.sectionsList.append(self.build_resample_tools())
+        self.sectionsList.append(self.build_lazy_section("render", "Step 5. Rendering", self.build_render_tools))
+        self.sectionsList.append(self.build_lazy_section("export", "Step 6. Export", self.build_export_tools))
+        self.sectionsList.append(self.build_lazy_section("resample", "(ADVANCED) Spacing Resample Tools", self.build_resample_tools))
         for s in self.sectionsList: self.layout.addWidget(s)
         self.layout.addStretch()
         self.update_slicer_view()
+        for side in atlasChecksums: ABLTemporalBoneSegmentationModuleLogic.start_atlas_prefetch(side)
+
+    def cleanup(self):
+        self.rigidTimer.stop()
+        if self.rigidJob is not None: self.rigidJob.cancel()
+        self.inferQueue.close()
+        ABLTemporalBoneSegmentationModuleLogic.close_docker_warmups()
+        ABLTemporalBoneSegmentationModuleLogic.close_remote_clients()
+        for section in self.sections.values(): section.detach()
+        ABLTemporalBoneSegmentationModuleLogic.clear_elastix_input_store()
 
     def build_volume_tools(self):
         section = InterfaceTools.build_dropdown("Volume Tools")
@@ -449,8 +1838,14 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         layout.setMargin(10)
         return section
 
-    def build_resample_tools(self):
-        section = InterfaceTools.build_dropdown("(ADVANCED) Spacing Resample Tools", disabled=True)
+    def build_lazy_section(self, key, title, build):
+        section = LazySection(title, build, disabled=True)
+        self.sections[key] = section
+        return section.button
+
+    def build_resample_tools(self, section):
+        self.init_resample_tools()
+        self.resampleButton.enabled = self.inferQueue.current is None
         # presets
         presets = qt.QWidget()
         layout = qt.QVBoxLayout(presets)
@@ -481,16 +1876,20 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         grid.addWidget(qt.QLabel("Interpolation Mode:"), 0, 0, 1, 1)
         grid.addWidget(self.resampleInterpolation, 0, 1, 1, 1)
         grid.addWidget(self.resampleButton, 0, 2, 1, 2)
+        grid.addWidget(qt.QLabel("Restrict to ROI:"), 1, 0, 1, 1)
+        grid.addWidget(self.resampleRoiSelector, 1, 1, 1, 3)
 
         layout = qt.QVBoxLayout(section)
         layout.addWidget(self.resampleInfoLabel)
         layout.addWidget(self.resampleTabBox)
         layout.addLayout(grid)
         layout.setMargin(10)
-        return section
+        self.sections["resample"].observe("resampleRoiSelector", self.resampleRoiSelector)
+        self.update_resample_info()
 
     def build_fiducial_registration(self):
-        section = InterfaceTools.build_dropdown("Step 1. Fiducial Registration", disabled=True)
+        self.sections["fiducial"] = LazySection("Step 1. Fiducial Registration", disabled=True)
+        section = self.sections["fiducial"].button
         layout = qt.QVBoxLayout(section)
         layout.addWidget(qt.QLabel("Set at least 3 fiducials. Setting more yields better results."))
         layout.addWidget(self.fiducialTabs)
@@ -501,6 +1900,7 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         row.addWidget(self.fiducialHardenButton)
         layout.addLayout(row)
         layout.setMargin(10)
+        self.sections["fiducial"].observe("fiducialPlacer", self.fiducialPlacer)
         return section
 
     def build_rigid_registration(self):
@@ -508,6 +1908,14 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         layout = qt.QVBoxLayout(section)
         layout.addWidget(qt.QLabel("Parameters: Elastix Rigid Registration"))
         layout.addWidget(self.rigidStatus)
+        row = qt.QHBoxLayout()
+        row.addWidget(self.rigidCacheCheckbox)
+        row.addWidget(self.rigidCacheLabel)
+        row.addWidget(self.rigidCacheClearButton)
+        layout.addLayout(row)
+        layout.addWidget(self.rigidEarlyExitCheckbox)
+        layout.addWidget(self.rigidDeferCheckbox)
+        self.update_rigid_cache_label()
         layout.addWidget(self.rigidApplyButton)
         layout.addWidget(self.rigidProgress)
         layout.addWidget(self.rigidCancelButton)
@@ -525,6 +1933,7 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
 
     def build_infer_tools(self):
         section = InterfaceTools.build_dropdown("Step 4. Inference", disabled=True)
+        section.connect('contentsCollapsed(bool)', self.click_infer_section)
         layout = qt.QVBoxLayout(section)
         layout.addWidget(self.inferSource)
         self.inferSource.connect("stateChanged(int)", self.click_infer_source)
@@ -548,6 +1957,7 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         rl.addWidget(self.inferStatus)
         rl.addWidget(self.inferProgressMajor)
         rl.addWidget(self.inferProgressMinor)
+        rl.addWidget(self.inferQueueLabel)
         layout.addWidget(self.inferRunWidget)
         self.inferRunWidget.visible = False
 
@@ -557,8 +1967,8 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
 
         return section
 
-    def build_export_tools(self):
-        section = InterfaceTools.build_dropdown("Step 6. Export", disabled=True)
+    def build_export_tools(self, section):
+        self.init_export_tools()
         layout = qt.QFormLayout(section)
         l = qt.QLabel("Export the segmentation and volume to CardinalSim. This will export the current moving volume and the segmentation selected below into a folder that can then be loaded into CardinalSim. Please ensure that the target folder is empty. Currently, CardinalSim requires volumes and segmentations to have the same pixel dimensions; the segmentation will be resampled to match the volume.")
         l.setWordWrap(True)
@@ -566,11 +1976,10 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         layout.addRow("Segmentation to Export:", self.exportSelector)
 
         layout.addWidget(self.exportButton)
+        self.sections["export"].observe("exportSelector", self.exportSelector)
 
-        return section
-
-    def build_render_tools(self):
-        section = InterfaceTools.build_dropdown("Step 5. Rendering", disabled=True)
+    def build_render_tools(self, section):
+        self.init_render_tools()
         layout = qt.QVBoxLayout(section)
         layout.addWidget(self.renderVolumeCheckbox)
         layout.addWidget(self.renderVolumeWidget)
@@ -586,12 +1995,19 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         b.connect("clicked(bool)", lambda: slicer.util.selectModule("VolumeRendering"))
         layout.addWidget(b)
 
-        return section
-
     # state checking ------------------------------------------------------------------------------
     def check_input_complete(self):
+        ## Loading the atlas may wait for its download while pumping events; the input and side
+        ## controls are disabled meanwhile, and anything they still queued mustn't start another load
+        if self.loadingAtlas: return
         if self.inputSelector.currentNode() is not None and (self.leftBoneCheckBox.isChecked() or self.rightBoneCheckBox.isChecked()):
-            self.finalize_input()
+            self.loadingAtlas = True
+            self.update_input_enabled()
+            try:
+                self.finalize_input()
+            finally:
+                self.loadingAtlas = False
+                self.update_input_enabled()
             self.update_slicer_view()
             self.click_fit_all_views()
             self.update_sections_enabled(enabled=True)
@@ -611,9 +2027,8 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         for f in self.fiducialSet:
             tab, f["table"] = InterfaceTools.build_fiducial_tab(f, self.click_fiducial_set_button, self.click_fiducial_clear_button)
             self.fiducialTabs.addTab(tab, f["label"])
-        # set spacing
-        spacing = ABLTemporalBoneSegmentationModuleLogic().get_um_spacing(self.inputSelector.currentNode().GetSpacing())
-        self.resampleInfoLabel.text = "The input volume was imported with a spacing of (X: " + str(spacing[0]) + "um,  Y: " + str(spacing[1]) + "um,  Z: " + str(spacing[2]) + "um)"
+        self.sections["fiducial"].select("fiducialPlacer", self.inputFiducialNode)
+        self.update_resample_info()
 
     def initialize_moving_volume(self):
         # node = slicer.vtkMRMLScalarVolumeNode()
@@ -625,8 +2040,7 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.movingSelector.setCurrentNode(self.inputSelector.currentNode())
         self.movingSelector.enabled = True
         self.movingSaveButton.enabled = True
-        spacing = ABLTemporalBoneSegmentationModuleLogic().get_um_spacing(self.movingSelector.currentNode().GetSpacing())
-        self.resampleSpacingXBox.value, self.resampleSpacingYBox.value, self.resampleSpacingZBox.value = spacing[0], spacing[1], spacing[2]
+        self.update_resample_info()
 
     def process_transform(self, function, corresponding_button=None, set_moving_volume=False):
         try:
@@ -652,6 +2066,15 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
             self.sectionsList[i].enabled = enabled
             # self.sectionsList[i].collapsed = not enabled
 
+    def update_resample_info(self):
+        if self.resampleInfoLabel is None: return ## Not built yet; this runs again when it is
+        if self.inputSelector.currentNode() is not None:
+            spacing = ABLTemporalBoneSegmentationModuleLogic().get_um_spacing(self.inputSelector.currentNode().GetSpacing())
+            self.resampleInfoLabel.text = "The input volume was imported with a spacing of (X: " + str(spacing[0]) + "um,  Y: " + str(spacing[1]) + "um,  Z: " + str(spacing[2]) + "um)"
+        if self.movingSelector.currentNode() is not None:
+            spacing = ABLTemporalBoneSegmentationModuleLogic().get_um_spacing(self.movingSelector.currentNode().GetSpacing())
+            self.resampleSpacingXBox.value, self.resampleSpacingYBox.value, self.resampleSpacingZBox.value = spacing[0], spacing[1], spacing[2]
+
     def update_slicer_view(self):
         moving = self.intermediateNode.GetID() if self.intermediateNode is not None else self.movingSelector.currentNode().GetID() if self.movingSelector.currentNode() is not None else None
         atlas = self.atlasNode.GetID() if self.atlasNode is not None else None
@@ -670,22 +2093,32 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.fiducialApplyButton.enabled = True if completed >= 3 else False
 
     def update_fiducial_buttons(self):
-        condition = self.intermediateNode is not None
+        condition = self.intermediateNode is not None and self.inferQueue.current is None
         self.fiducialHardenButton.enabled = condition
         self.fiducialRevertButton.enabled = condition
 
     def update_rigid_progress(self, text):
-        print(text)
-        progress = ABLTemporalBoneSegmentationModuleLogic.process_rigid_progress(text)
-        self.rigidStatus.text = 'Status: ' + ((text[:60] + '..') if len(text) > 60 else text)
-        if progress is not None: self.rigidProgress.value = progress
-        if progress is 100:
+        self.rigidProgressBus.post(text)
+
+    def refresh_rigid_progress(self, lines, state):
+        if lines:
+            text = lines[-1]
+            self.rigidStatus.text = 'Status: ' + ((text[:60] + '..') if len(text) > 60 else text)
+        progress = state.get('progress')
+        if progress is not None:
+            self.rigidProgress.value = progress
+            eta = ElastixProgressParser.format_eta(state.get('eta'))
+            self.rigidProgress.setFormat('%p% (' + eta + ')' if eta else '%p%')
+        if progress == 100:
             self.rigidProgress.visible = False
             self.rigidCancelButton.visible = False
             p = qt.QPalette()
             p.setColor(qt.QPalette.WindowText, qt.Qt.green)
             self.rigidStatus.setPalette(p)
-        slicer.app.processEvents()  # force update
+
+    def update_rigid_cache_label(self):
+        entries = ABLTemporalBoneSegmentationModuleLogic.get_transform_cache().entries()
+        self.rigidCacheLabel.text = "%d cached (%.1f KB)" % (len(entries), sum(e[1] for e in entries)/1024.0)
 
     def update_crop_buttons(self):
         self.cropStartButton.visible = not self.isCropping
@@ -711,13 +2144,15 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
 
     def click_right_bone(self, val=True, force=False):
         if force: self.rightBoneCheckBox.setChecked(True)
-        if self.rightBoneCheckBox.isChecked(): self.leftBoneCheckBox.setChecked(False)
+        if self.rightBoneCheckBox.isChecked():
+            self.leftBoneCheckBox.setChecked(False)
         if not force: self.check_input_complete()
         self.update_sections_enabled(self.inputSelector.currentNode() is not None and (self.rightBoneCheckBox.isChecked() or self.leftBoneCheckBox.isChecked()))
 
     def click_left_bone(self, val=True, force=False):
         if force: self.leftBoneCheckBox.setChecked(True)
-        if self.leftBoneCheckBox.isChecked(): self.rightBoneCheckBox.setChecked(False)
+        if self.leftBoneCheckBox.isChecked():
+            self.rightBoneCheckBox.setChecked(False)
         if not force: self.check_input_complete()
         self.update_sections_enabled(self.inputSelector.currentNode() is not None and (self.rightBoneCheckBox.isChecked() or self.leftBoneCheckBox.isChecked()))
 
@@ -732,7 +2167,8 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
             if self.resampleTabBox.currentIndex == 0: spacing = supportedResamplePresets[self.resamplePresetBox.currentIndex]['value']
             else: spacing = [self.resampleSpacingXBox.value, self.resampleSpacingYBox.value, self.resampleSpacingZBox.value]
             spacing = [float(i)/1000 for i in spacing]
-            return ABLTemporalBoneSegmentationModuleLogic().pull_node_resample_push(self.movingSelector.currentNode(), spacing, supportedResampleInterpolations[self.resampleInterpolation.currentIndex]['value'])
+            return ABLTemporalBoneSegmentationModuleLogic().pull_node_resample_push(self.movingSelector.currentNode(), spacing, getattr(sitk, supportedResampleInterpolations[self.resampleInterpolation.currentIndex]['value']),
+                                                                                  roi_node=self.resampleRoiSelector.currentNode())
         self.process_transform(function, set_moving_volume=True)
 
     def click_fiducial_tab(self, index):
@@ -797,26 +2233,60 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.process_transform(function, set_moving_volume=True)
 
     def click_rigid_apply(self):
-        def transform():
-            p = qt.QPalette()
-            p.setColor(qt.QPalette.WindowText, qt.Qt.gray)
-            self.rigidStatus.setPalette(p)
-            self.rigidProgress.value = 0
-            self.rigidProgress.visible = True
-            self.rigidCancelButton.visible = True
-            self.rigidApplyButton.visible = False
-            return ABLTemporalBoneSegmentationModuleLogic().apply_elastix_rigid_registration(elastix=self.elastixLogic,
-                                                                                        atlas_node=self.atlasNode,
-                                                                                        moving_node=self.movingSelector.currentNode(),
-                                                                                        mask_node=self.maskNode,
-                                                                                        log_callback=self.update_rigid_progress)
-        self.process_transform(transform, corresponding_button=self.rigidApplyButton, set_moving_volume=True)
+        p = qt.QPalette()
+        p.setColor(qt.QPalette.WindowText, qt.Qt.gray)
+        self.rigidStatus.setPalette(p)
+        self.rigidProgress.value = 0
+        self.rigidProgress.visible = True
+        self.rigidCancelButton.visible = True
+        self.rigidApplyButton.visible = False
+        try:
+            slicer.app.setOverrideCursor(qt.Qt.WaitCursor)
+            self.elastixLogic = self.elastixLogic or ABLTemporalBoneSegmentationModuleLogic.get_elastix_logic()
+            self.rigidJob = ABLTemporalBoneSegmentationModuleLogic.start_elastix_rigid_registration(elastix=self.elastixLogic,
+                                                                                                    atlas_node=self.atlasNode,
+                                                                                                    moving_node=self.movingSelector.currentNode(),
+                                                                                                    mask_node=self.maskNode,
+                                                                                                    log_callback=self.update_rigid_progress,
+                                                                                                    use_cache=self.rigidCacheCheckbox.isChecked(),
+                                                                                                    early_exit=self.rigidEarlyExitCheckbox.isChecked())
+            self.rigidTimer.start()
+        except Exception as e:
+            self.rigidJob = None
+            self.update_rigid_progress("Error: {0}".format(e))
+            traceback.print_exc()
+            self.reset_rigid_buttons()
+        finally:
+            slicer.app.restoreOverrideCursor()
 
-    def click_rigid_cancel(self):
+    def poll_rigid_registration(self):
+        if self.rigidJob is None: return
+        running = self.rigidJob.poll()
+        self.rigidProgressBus.post(progress=self.rigidJob.progress, eta=self.rigidJob.eta())
+        if running: return
+        self.rigidTimer.stop()
+        self.rigidProgressBus.flush()
+        job, self.rigidJob = self.rigidJob, None
+        if job.status == JobStatus.COMPLETE:
+            self.process_transform(lambda: ABLTemporalBoneSegmentationModuleLogic.finish_elastix_rigid_registration(job, harden=not self.rigidDeferCheckbox.isChecked()),
+                                   corresponding_button=self.rigidApplyButton, set_moving_volume=True)
+        else:
+            self.reset_rigid_buttons()
+        self.update_rigid_cache_label()
+
+    def reset_rigid_buttons(self):
         self.rigidProgress.value = 0
         self.rigidProgress.visible = False
         self.rigidCancelButton.visible = False
-        ABLTemporalBoneSegmentationModuleLogic.attempt_abort_rigid_registration(self.elastixLogic)
+        self.rigidApplyButton.enabled = self.rigidApplyButton.visible = True
+
+    def click_rigid_clear_cache(self):
+        ABLTemporalBoneSegmentationModuleLogic.get_transform_cache().clear()
+        self.update_rigid_cache_label()
+
+    def click_rigid_cancel(self):
+        if self.rigidJob is not None: ABLTemporalBoneSegmentationModuleLogic.attempt_abort_rigid_registration(self.rigidJob)
+        self.poll_rigid_registration()
 
     def click_crop_start(self):
         # cropParams = slicer.vtkMRMLCropVolumeParametersNode()
@@ -832,24 +2302,11 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
 
     def click_crop_accept(self):
         def transform():
-            # copy input
-            outputVolumeNode = slicer.vtkMRMLScalarVolumeNode()
-            outputVolumeNode.Copy(self.movingSelector.currentNode())
-            outputVolumeNode.SetName(self.movingSelector.currentNode().GetName() + "_Crop")
-            slicer.mrmlScene.AddNode(outputVolumeNode)
-
-            # build and apply crop params
-            cropParams = slicer.vtkMRMLCropVolumeParametersNode()
-            cropParams.SetScene(slicer.mrmlScene)
-            cropParams.SetIsotropicResampling(False)
-            cropParams.SetInterpolationMode(2)
-            cropParams.SetFillValue(-3000)
-            # cropParams.SetSpacingScalingConst(0.5)
-            cropParams.SetInputVolumeNodeID(self.movingSelector.currentNode().GetID())
-            cropParams.SetROINodeID(self.roiNode.GetID())
-            cropParams.SetOutputVolumeNodeID(outputVolumeNode.GetID())
-            slicer.modules.cropvolume.logic().Apply(cropParams)
-
+            node = self.movingSelector.currentNode()
+            if node.GetParentTransformNode() is not None:
+                outputVolumeNode = ABLTemporalBoneSegmentationModuleLogic.crop_transformed_volume(node, self.roiNode)
+            else:
+                outputVolumeNode = ABLTemporalBoneSegmentationModuleLogic.crop_volume(node, self.roiNode)
             # remove ROI
             slicer.mrmlScene.RemoveNode(self.roiNode)
             self.roiNode = None
@@ -858,12 +2315,18 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         self.isCropping = False
         self.update_crop_buttons()
 
+    def click_infer_section(self, collapsed):
+        ## Get Docker ready while the user is still looking at the settings
+        if not collapsed and not self.inferSource.checked:
+            ABLTemporalBoneSegmentationModuleLogic.start_docker_warmup(self.inferDockerHost.text.strip())
+
     def click_infer_source(self, state):
         state = bool(state)
         self.inferServerWidget.visible = state
         self.inferDockerWidget.visible = not state
 
     def _infer_progress(self, sec, f1, f2, s):
+        DispatchStage = import_ablinfer().constants.DispatchStage
         sec_map = {
             DispatchStage.Initial: (0, 5),
             DispatchStage.Validate: (5, 5),
@@ -875,7 +2338,7 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
         }
 
         if sec == DispatchStage.Run:
-            self.inferStatus.text = "Running inference..."
+            status = "Running inference..."
             if "inference iter" in s:
                 try:
                     b = int(s.split("inference iter")[1].split(',')[0])
@@ -884,37 +2347,35 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
                     pass
             f1 = self._infer_last_run_progress
             f2 = self._infer_last_run_progress
-            print(s)
+            log = s
         else:
-            self.inferStatus.text = s
+            status, log = s, None
+            job = self.inferQueue.current
+            client = ABLTemporalBoneSegmentationModuleLogic._remoteClients.get(job.config.get("base_url")) if job is not None else None
+            transfer = client.adapter.throughput("upload" if sec == DispatchStage.Save else "download") if client is not None and sec in (DispatchStage.Save, DispatchStage.Load) else None
+            if transfer is not None: status += " (%.1f MB at %.1f MB/s)" % (transfer[0]/1048576.0, transfer[1]/1048576.0)
         add, length = sec_map[sec]
-        self.inferProgressMajor.value = add + int(length*f1)
-        self.inferProgressMinor.value = int(100*f2)
+        self.inferProgressBus.post(log, status=status, major=add + int(length*f1), minor=int(100*f2))
 
-        slicer.app.processEvents()
+    def refresh_infer_progress(self, lines, state):
+        if "status" in state: self.inferStatus.text = state["status"]
+        if "major" in state: self.inferProgressMajor.value = state["major"]
+        if "minor" in state: self.inferProgressMinor.value = state["minor"]
 
     def click_infer_apply(self):
-        inp = self.movingSelector.currentNode()
+        inp = ABLTemporalBoneSegmentationModuleLogic.harden_transforms(self.movingSelector.currentNode())
 
         remote = bool(self.inferSource.checked)
 
         ## First load the model
         try:
-            with open(os.path.join(os.path.dirname(__file__), "Resources", "Models", "ABLTempSeg.json"), 'r') as f:
-                model = json.load(f)
+            model = ABLTemporalBoneSegmentationModuleLogic.load_inference_model()
         except Exception as e:
             traceback.print_exc()
             slicer.util.errorDisplay("Unable to load inference model:\n" + ''.join(traceback.format_exc()))
             return
 
         ## Now assemble the configuration
-        config = {
-            "tmp_path": os.path.join(os.path.expanduser("~"), ".ablinfer")
-        }
-
-        if not os.path.isdir(config["tmp_path"]):
-            os.makedirs(config["tmp_path"])
-
         settings = slicer.app.settings()
         if remote: ## Remote server
             host = self.inferServerHost.text.strip()
@@ -929,77 +2390,59 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
                 slicer.util.errorDisplay("A password is required if you enter a username!")
                 return
             
-            ## Setup the session
-            s = requests.Session()
-            s.verify = False
             if username:
-                s.auth = (username, password)
                 settings.setValue("ablinfer_server_username", username) 
                 settings.setValue("ablinfer_server_password", password)
 
-            config["base_url"] = host
-            config["session"] = s
-
-            dispatch = SlicerDispatchRemote
-            is_docker = False
-
+            config, dispatch = ABLTemporalBoneSegmentationModuleLogic.build_inference_config(remote=True, host=host, username=username, password=password)
             ## Store the updated parameters
             settings.setValue("ablinfer_server_host", host)
         else: ## Local docker instance
-            docker = self.inferDockerHost.text.strip()
-            is_docker = True
-            
-            if docker:
-                config["docker"] = {"base_url": docker}
-
-            dispatch = SlicerDispatchDocker
-            settings.setValue("ablinfer_docker_host", docker)
+            docker_host = self.inferDockerHost.text.strip()
+            config, dispatch = ABLTemporalBoneSegmentationModuleLogic.build_inference_config(remote=False, docker_host=docker_host)
+            settings.setValue("ablinfer_docker_host", docker_host)
+            ABLTemporalBoneSegmentationModuleLogic.start_docker_warmup(docker_host)
         
         good_volume = bool(self.inferGoodVolume.isChecked())
-        model_config = {
-            "inputs": {
-                "input_vol": {
-                    "value": inp,
-                },
-            },
-            "outputs": {
-                "input_vol_resampled": {
-                    "enabled": good_volume,
-                    "value": None,
-                },
-                "output_seg": {
-                    "value": None,
-                    "enabled": True,
-                    "post": [
-                        { ## Island removal (done in container)
-                            "enabled": False,
-                        },
-                        { ## Show result
-                            "enabled": True,
-                            "params": {
-                                "smoothing": 0.5,
-                            },
-                        },
-                    ],
-                },
-            },
-        }
+        model_config = ABLTemporalBoneSegmentationModuleLogic.build_model_config(inp, good_volume)
 
-        ## We're ready to run
+        ## We're ready to run; anything already running keeps the model busy until this one's turn
+        job = InferenceJob(inp, config, dispatch, model, model_config)
+        ahead = self.inferQueue.put(job)
         self.inferRunWidget.visible = True
+        if ahead > 0: self.update_infer_queue_label("Queued %s behind %d other scan(s)" % (job.name, ahead))
+
+    def update_infer_queue_label(self, text=None):
+        queued = len(self.inferQueue.jobs)
+        self.inferQueueLabel.text = text or ("%d more scan(s) queued" % queued if queued else "")
+
+    def update_infer_busy(self, busy):
+        ## The running job pumps the event loop, so keep the input, side, crop, resample and fiducial
+        ## harden/revert handlers from replacing or removing volumes in the middle of its dispatch
+        for w in (self.cropStartButton, self.cropAcceptButton, self.resampleButton):
+            if w is not None: w.enabled = not busy
+        self.update_input_enabled()
+        self.update_fiducial_buttons()
+
+    def update_input_enabled(self):
+        enabled = not self.loadingAtlas and self.inferQueue.current is None
+        for w in (self.inputSelector, self.leftBoneCheckBox, self.rightBoneCheckBox): w.enabled = enabled
+
+    def start_inference(self, job):
         self._infer_last_run_progress = 0
-        try:
-            ABLTemporalBoneSegmentationModuleLogic.run_inference(
-                config, 
-                model, 
-                model_config,
-                dispatch=dispatch,
-                progress=self._infer_progress,
-                get_model=True,
-            )
-        except Exception as e:
-            traceback.print_exc()
-            formetted = traceback.format_exc()
+        self.update_infer_queue_label()
+        self.update_infer_busy(True)
+
+    def finish_inference(self, job):
+        self.update_infer_busy(False)
+        self.inferProgressBus.flush()
+        self.update_infer_queue_label()
+        if job.status != JobStatus.COMPLETE:
+            import docker
+            import requests
+            e = job.error
+            print(job.traceback)
+            is_docker = job.config.get("base_url") is None
             if isinstance(e, docker.errors.ImageNotFound):
                 slicer.util.errorDisplay("Unable to find the model's Docker image: %s.\nThis means that the Docker image isn't available locally and isn't available on the Docker repository; you will have to download it manually.")
             elif isinstance(e, docker.errors.APIError):
@@ -1009,16 +2452,23 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
                     slicer.util.errorDisplay("Error communicating with the Docker daemon: %s.\nThis usually means that either Docker isn't running, is running in an unusual spot (which you must set in the \"Docker Host\" configuration, or you don't have permission to access it." % repr(e))
                 else:
                     slicer.util.errorDisplay("Error with remote connection: %s.\nThis usually means that something is wrong with the remote server or your internet connection." % repr(e))
-            elif isinstance(e, DispatchException):
+            elif isinstance(e, import_ablinfer().base.DispatchException):
                 slicer.util.errorDisplay("Error running model: %s\nThis is usually caused by a problem with your configuration or your input." % repr(e))
             else:
-                slicer.util.errorDisplay("Error running inference:\n"+''.join(traceback.format_exc()))
-        else:
-            if good_volume:
-                self.movingSelector.setCurrentNode(model_config["outputs"]["input_vol_resampled"]["value"])
-            self._infer_progress(DispatchStage.Postprocess, 1, 1, "Finished!")
-            self.switch_to_3dview()
-            self.exportSelector.setCurrentNode(model_config["outputs"]["output_seg"]["value"])
+                slicer.util.errorDisplay("Error running inference on %s:\n%s" % (job.name, job.traceback))
+            return
+        outputs = job.model_config["outputs"]
+        self._infer_progress(import_ablinfer().constants.DispatchStage.Postprocess, 1, 1, "Finished %s in %.0f s" % (job.name, job.elapsed))
+        if job.startup is not None:
+            print("Inference of %s started computing after %.1f s (%s); session %s" % (job.name, job.startup, {True: "image ready", False: "image not ready", None: "remote"}[job.image_ready],
+                                                                                       self.inferQueue.describe_latency(job.target())))
+        self.inferProgressBus.flush()
+        ## If the user has moved on to the next scan, leave the result in the scene instead of switching to it
+        if self.movingSelector.currentNode() is not job.input_node: return
+        if outputs["input_vol_resampled"]["enabled"]:
+            self.movingSelector.setCurrentNode(outputs["input_vol_resampled"]["value"])
+        self.switch_to_3dview()
+        self.sections["export"].select("exportSelector", outputs["output_seg"]["value"])
 
     def switch_to_3dview(self):
         if self.atlasFiducialNode is not None:
@@ -1162,6 +2612,15 @@ class ABLTemporalBoneSegmentationModuleWidget(ScriptedLoadableModuleWidget):
 
 # Main Logic
 class ABLTemporalBoneSegmentationModuleLogic(ScriptedLoadableModuleLogic):
+    _volumeHashes = {}
+    _transformCache = None
+    _inferenceCache = None
+    _atlasPrefetch = None
+    _elastixLogic = None
+    _elastixInputStore = None
+    _dockerWarmups = {}
+    _remoteClients = {}
+
     @staticmethod
     def update_slicer_view(moving, atlas, overlay_opacity):
         slicer.app.layoutManager().setLayout(21)
@@ -1191,24 +2650,37 @@ class ABLTemporalBoneSegmentationModuleLogic(ScriptedLoadableModuleLogic):
         return inputFiducialNode, fiducial_set
 
     @staticmethod
-    def load_atlas_and_fiducials_and_mask(side_indicator):
+    def load_atlas_and_fiducials_and_mask(side_indicator, show_progress=True):
         atlasNode = slicer.mrmlScene.GetFirstNodeByName('Atlas_' + side_indicator)
         atlasFiducialNode = slicer.mrmlScene.GetFirstNodeByName('Atlas_' + side_indicator + ' Fiducials')
         framePath = slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + "/Resources/Atlases/"
+        sums = atlasChecksums
+        store = ABLTemporalBoneSegmentationModuleLogic.get_atlas_store()
+        prefetch = ABLTemporalBoneSegmentationModuleLogic._atlasPrefetch
+        if atlasNode is None and prefetch is not None and not store.in_memory('Atlas_' + side_indicator, sums[side_indicator]):
+            ## Only blocks if the background download hasn't finished yet
+            image = prefetch.result(side_indicator)
+            if image is not None:
+                atlasNode = sitku.PushVolumeToSlicer(image, None, 'Atlas_' + side_indicator, "vtkMRMLScalarVolumeNode")
+                atlasNode.HideFromEditorsOn()
+                store.remember(atlasNode, sums[side_indicator])
+        if atlasNode is None:
+            ## Reuse the atlas from an earlier download if we have it
+            atlasNode = store.load('Atlas_' + side_indicator, sums[side_indicator])
+            if atlasNode is not None: atlasNode.HideFromEditorsOn()
         if atlasNode is None:
             ## Download the atlas from the git release
-            sums = {
-                "L": "SHA256:594d78fdd47b9e4e78b9edfe605eebdb11cdbb0aec690c89d2d3fe9b634a389f",
-                "R": "SHA256:258c1c140438134d15bca09c6289335248bb2a6dc415edd677fcf55f29e644a3",
-            }
 
+            import SampleData
             logic = SampleData.SampleDataLogic()
-            window = slicer.util.createProgressDialog()
+            window = slicer.util.createProgressDialog() if show_progress else None
 
             ## Show a progress window, per the wiki:
             ## https://www.slicer.org/wiki/Documentation/Nightly/ScriptRepository#Load_volume_from_URL
             def progress(msg, level=None):
                 print("Downloading atlas... %d%%" % logic.downloadPercent)
+                if not show_progress:
+                    return
                 if window.wasCanceled:
                     slicer.util.errorDisplay("Download canceled! This atlas file MUST be downloaded for this module to work properly.")
                     raise Exception("Download canceled!")
@@ -1220,43 +2692,344 @@ class ABLTemporalBoneSegmentationModuleLogic(ScriptedLoadableModuleLogic):
 
             try:
                 logic.logMessage = progress
-                atlasNode, = logic.downloadFromURL(nodeNames="Atlas_"+side_indicator, fileNames="Atlas_%s.mha" % side_indicator, uris="https://github.com/Auditory-Biophysics-Lab/temporal-bone-segmentation/releases/download/v1.0/Atlas_%s.mha" % side_indicator, checksums=sums[side_indicator])
+                atlasNode, = logic.downloadFromURL(nodeNames="Atlas_"+side_indicator, fileNames="Atlas_%s.mha" % side_indicator, uris=atlasUrl % side_indicator, checksums=sums[side_indicator])
             finally:
-                window.close()
+                if window is not None: window.close()
 
             atlasNode.HideFromEditorsOn()
+            try:
+                store.put(atlasNode, sums[side_indicator])
+            except Exception:
+                logging.warning("Could not store the atlas locally:\n" + traceback.format_exc())
         if atlasFiducialNode is None:
             atlasFiducialNode = slicer.util.loadMarkups(framePath + 'Fiducial_' + side_indicator + '.fcsv')
             atlasFiducialNode.SetName('Atlas_' + side_indicator + ' Fiducials')
             atlasFiducialNode.SetLocked(True)
             atlasFiducialNode.HideFromEditorsOn()
         framePath = slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + "/Resources/Masks/"
-        maskNode = slicer.util.loadVolume(framePath + 'CochleaRegistrationMask_' + side_indicator + '.nrrd')
+        maskName = 'CochleaRegistrationMask_' + side_indicator
+        maskNode = slicer.mrmlScene.GetFirstNodeByName(maskName)
+        if maskNode is None:
+            maskNode = slicer.util.loadVolume(framePath + maskName + '.nrrd', {"name": maskName, "show": False})
+            maskNode.HideFromEditorsOn()
+        ABLTemporalBoneSegmentationModuleLogic.remove_duplicate_nodes(maskNode)
         return atlasNode, atlasFiducialNode, maskNode
 
+    @staticmethod
+    def get_atlas_store():
+        return AtlasStore(os.path.join(slicer.app.cachePath, "ABLTemporalBoneSegmentation", "Atlases"))
+
+    @staticmethod
+    def start_atlas_prefetch(side):
+        """Start fetching a side's atlas in the background, unless disabled in the settings or
+        already started this session."""
+        if side not in atlasChecksums: return
+        if str(slicer.app.settings().value("ABLTemporalBoneSegmentation/PrefetchAtlases", "true")).lower() not in ("true", "1"): return
+        if ABLTemporalBoneSegmentationModuleLogic._atlasPrefetch is None:
+            ABLTemporalBoneSegmentationModuleLogic._atlasPrefetch = AtlasPrefetch(ABLTemporalBoneSegmentationModuleLogic.get_atlas_store())
+        ABLTemporalBoneSegmentationModuleLogic._atlasPrefetch.start(side)
+
+    @staticmethod
+    def start_docker_warmup(docker_host=None):
+        """Start getting the Docker daemon ready for the model (see :class:`DockerWarmup`), once per daemon and
+        session, unless disabled in the settings."""
+        key = docker_host or ""
+        if key in ABLTemporalBoneSegmentationModuleLogic._dockerWarmups: return ABLTemporalBoneSegmentationModuleLogic._dockerWarmups[key]
+        if str(slicer.app.settings().value("ABLTemporalBoneSegmentation/WarmDocker", "true")).lower() not in ("true", "1"): return None
+        try:
+            model = ABLTemporalBoneSegmentationModuleLogic.load_inference_model()
+        except Exception as e:
+            logging.warning("Not warming up Docker, the inference model could not be loaded: " + str(e))
+            return None
+        warmup = ABLTemporalBoneSegmentationModuleLogic._dockerWarmups[key] = DockerWarmup(model, docker_host)
+        return warmup
+
+    @staticmethod
+    def close_docker_warmups():
+        for warmup in ABLTemporalBoneSegmentationModuleLogic._dockerWarmups.values(): warmup.close()
+        ABLTemporalBoneSegmentationModuleLogic._dockerWarmups = {}
+
+    @staticmethod
+    def remove_duplicate_nodes(node):
+        """Remove other nodes of the same class that were loaded under the same name (``name`` or
+        ``name_<n>``), e.g. by repeatedly loading the same file."""
+        pattern = re.compile(re.escape(node.GetName()) + r'(_\d+)?$')
+        nodes = slicer.mrmlScene.GetNodesByClass(node.GetClassName())
+        nodes.UnRegister(None)
+        duplicates = [nodes.GetItemAsObject(i) for i in range(nodes.GetNumberOfItems())]
+        duplicates = [d for d in duplicates if d is not node and pattern.match(d.GetName())]
+        for duplicate in duplicates:
+            slicer.mrmlScene.RemoveNode(duplicate)
+        return len(duplicates)
+
     @staticmethod
     def get_um_spacing(spacing):
         return [int(s*1000) for s in spacing]
 
     @staticmethod
-    def resample_image(image, spacing, interpolation):
+    def get_resample_size(image, spacing):
         oldSpacing = [float("%.3f" % f) for f in image.GetSpacing()]
+        return [int(a * (b / c)) for a, b, c in zip(image.GetSize(), oldSpacing, spacing)]
+
+    @staticmethod
+    def estimate_resample_bytes(image, spacing, region=None):
+        """Predict the size of :meth:`resample_image`'s output, which has the input's pixel type."""
+        size = region[1] if region is not None else ABLTemporalBoneSegmentationModuleLogic.get_resample_size(image, spacing)
+        voxels = int(np.prod(size, dtype=np.int64))
+        return voxels*image.GetNumberOfComponentsPerPixel()*image.GetSizeOfPixelComponent()
+
+    @staticmethod
+    def get_resample_memory_budget():
+        """The largest resample output, in bytes, that is built in memory rather than on disk."""
+        return int(float(slicer.app.settings().value("ABLTemporalBoneSegmentation/ResampleMemoryBudgetMB", 4096))*1024*1024)
+
+    @staticmethod
+    def write_nrrd_header(f, size, origin, spacing, direction, components, dtype):
+        """Write the header of an attached, raw encoded NRRD file for an LPS image grid.
+
+        :param f: The binary file to write to; the voxel data must follow the header.
+        :param size: The image size.
+        :param origin: The image origin.
+        :param spacing: The image spacing.
+        :param direction: The image direction, as returned by SimpleITK.
+        :param components: Number of components per voxel.
+        :param dtype: The numpy type of the voxels.
+        """
+        types = {'int8': 'signed char', 'uint8': 'uchar', 'int16': 'short', 'uint16': 'ushort', 'int32': 'int',
+                 'uint32': 'uint', 'int64': 'longlong', 'uint64': 'ulonglong', 'float32': 'float', 'float64': 'double'}
+        directions = ['(%s)' % ','.join(repr(direction[3*r + i]*spacing[i]) for r in range(3)) for i in range(3)]
+        lines = ['NRRD0004', 'type: ' + types[np.dtype(dtype).name]]
+        if components > 1:
+            lines += ['dimension: 4', 'space: left-posterior-superior', 'sizes: %d %d %d %d' % ((components,) + tuple(size)),
+                      'space directions: none ' + ' '.join(directions), 'kinds: vector domain domain domain']
+        else:
+            lines += ['dimension: 3', 'space: left-posterior-superior', 'sizes: %d %d %d' % tuple(size),
+                      'space directions: ' + ' '.join(directions), 'kinds: domain domain domain']
+        lines += ['endian: ' + ('little' if sys.byteorder == 'little' else 'big'), 'encoding: raw',
+                  'space origin: (%s)' % ','.join(repr(float(o)) for o in origin)]
+        f.write(('\n'.join(lines) + '\n\n').encode('ascii'))
+
+    @staticmethod
+    def get_roi_region(image, spacing, roi_node):
+        """Find the part of :meth:`resample_image`'s output grid that an ROI covers.
+
+        :param image: The SimpleITK image to resample.
+        :param spacing: The new spacing.
+        :param roi_node: The ROI node; its RAS bounds are used, so any parent transform is honoured.
+        :returns: The ``(index, size)`` of the covered region, for :meth:`resample_image`.
+        """
+        newSize = ABLTemporalBoneSegmentationModuleLogic.get_resample_size(image, spacing)
+        grid = sitk.Image([1, 1, 1], sitk.sitkUInt8)
+        grid.SetOrigin(image.GetOrigin()); grid.SetSpacing(spacing); grid.SetDirection(image.GetDirection())
+        bounds = [0]*6
+        roi_node.GetRASBounds(bounds)
+        ## RAS to LPS
+        corners = [grid.TransformPhysicalPointToContinuousIndex([-bounds[i], -bounds[2 + j], bounds[4 + k]]) for i in (0, 1) for j in (0, 1) for k in (0, 1)]
+        lower = [max(0, int(np.floor(min(c[d] for c in corners) + 0.5))) for d in range(3)]
+        upper = [min(newSize[d] - 1, int(np.floor(max(c[d] for c in corners) + 0.5))) for d in range(3)]
+        if any(u < l for l, u in zip(lower, upper)): raise ValueError("The ROI does not overlap the volume")
+        return lower, [u - l + 1 for l, u in zip(lower, upper)]
+
+    @staticmethod
+    def resample_image(image, spacing, interpolation, threads=None, slab_voxels=8*1024*1024, output_path=None, region=None):
+        """Resample an image to a new spacing, keeping its origin and direction.
+
+        :param image: The SimpleITK image to resample.
+        :param spacing: The new spacing.
+        :param interpolation: A SimpleITK interpolator.
+        :param threads: Number of slabs resampled at once; defaults to the number of cores.
+        :param slab_voxels: Upper bound on the number of output voxels per slab.
+        :param output_path: If given, the output buffer is a memory-mapped NRRD file at this path
+                            instead of an in-memory array, so outputs larger than the RAM can be
+                            built.
+        :param region: Optional ``(index, size)`` of the part of the output grid to compute (see
+                       :meth:`get_roi_region`); the result is the same as cropping the full
+                       output to it, but only the voxels inside are interpolated.
+        :returns: The resampled SimpleITK image, or ``output_path`` if it was given.
+        """
+        start, size = region or ([0, 0, 0], ABLTemporalBoneSegmentationModuleLogic.get_resample_size(image, spacing))
+        ## The output grid, and where the (possibly cropped) output starts on it
+        reference = sitk.Image([1, 1, 1], image.GetPixelID())
+        reference.SetOrigin(image.GetOrigin()); reference.SetSpacing(spacing); reference.SetDirection(image.GetDirection())
+        return ABLTemporalBoneSegmentationModuleLogic.resample_to_grid(image, reference.TransformIndexToPhysicalPoint(start), spacing, image.GetDirection(), size,
+                                                                       interpolation, threads=threads, slab_voxels=slab_voxels, output_path=output_path)
+
+    @staticmethod
+    def get_interpolation_margin(interpolation, spacing):
+        """The number of input voxels, per axis, beyond the nearest ones that an interpolator reads.
+
+        :param interpolation: A SimpleITK interpolator.
+        :param spacing: The input spacing.
+        :returns: A margin for each axis.
+        """
+        if interpolation in (sitk.sitkGaussian, sitk.sitkLabelGaussian):
+            ## SimpleITK builds these with a sigma of 0.8 (label: 1.0) mm cut off at 4 (label: 1) sigmas;
+            ## recent versions scale sigma by the spacing instead, so cover whichever reaches further
+            sigma, alpha = (0.8, 4.0) if interpolation == sitk.sitkGaussian else (1.0, 1.0)
+            return [int(np.ceil(alpha*sigma*max(1.0/s, 1.0))) + 1 for s in spacing]
+        if interpolation == sitk.sitkNearestNeighbor: return [0]*3
+        if interpolation == sitk.sitkLinear: return [1]*3
+        if interpolation in (sitk.sitkHammingWindowedSinc, sitk.sitkBlackmanWindowedSinc, sitk.sitkCosineWindowedSinc,
+                             sitk.sitkWelchWindowedSinc, sitk.sitkLanczosWindowedSinc):
+            ## SimpleITK's windowed sinc kernels have a radius of 3 voxels
+            return [4]*3
+        ## B-splines read 2 voxels around the point, but their prefilter runs over the whole input;
+        ## its influence falls off by 0.27 per voxel, so 8 voxels bring the difference below 1e-4
+        return [8]*3
+
+    @staticmethod
+    def benchmark_resample(image, spacing, interpolation, threads=None, repeats=3):
+        """Time the slab-parallel :meth:`resample_image` against a single multithreaded
+        ``sitk.Resample`` of the whole image, and compare their outputs.
+
+        The slabs are resampled by single-threaded filters from Python threads, so they only run
+        in parallel as far as SimpleITK releases the GIL; this tells whether they are worth it on
+        this machine.
+
+        :param image: The SimpleITK image to resample.
+        :param spacing: The new spacing.
+        :param interpolation: A SimpleITK interpolator.
+        :param threads: Number of slabs resampled at once; defaults to the number of cores.
+        :param repeats: The best of this many runs of each is reported.
+        :returns: A dict with the best ``slabs`` and ``resample`` times in seconds and the
+                  ``max_difference`` between the two outputs.
+        """
+        size = ABLTemporalBoneSegmentationModuleLogic.get_resample_size(image, spacing)
+        times = {'slabs': float('inf'), 'resample': float('inf')}
+        for _ in range(repeats):
+            start = time.perf_counter()
+            slabs = ABLTemporalBoneSegmentationModuleLogic.resample_image(image, spacing, interpolation, threads=threads)
+            times['slabs'] = min(times['slabs'], time.perf_counter() - start)
+            start = time.perf_counter()
+            whole = sitk.Resample(image, size, sitk.Transform(), interpolation, image.GetOrigin(), spacing, image.GetDirection(), 0, image.GetPixelID())
+            times['resample'] = min(times['resample'], time.perf_counter() - start)
+        difference = sitk.GetArrayViewFromImage(slabs).astype(np.float64) - sitk.GetArrayViewFromImage(whole)
+        times['max_difference'] = float(np.abs(difference).max()) if difference.size else 0.0
+        return times
+
+    @staticmethod
+    def resample_to_grid(image, origin, spacing, direction, size, interpolation, transform=None, default_value=0,
+                         threads=None, slab_voxels=8*1024*1024, output_path=None):
+        """Resample an image onto an arbitrary output grid.
+
+        The output is split into slabs along its last axis. Each slab only reads the part of the
+        input it covers (plus the interpolation kernel's support, see
+        :meth:`get_interpolation_margin`), so interpolators that
+        preprocess their whole input, like B-spline, work on slab sized pieces. Slabs are resampled
+        in parallel and copied into a single output buffer as they finish, which bounds the
+        working memory to about ``threads`` slabs on top of the input and output.
+
+        :param image: The SimpleITK image to resample.
+        :param origin: The output origin.
+        :param spacing: The output spacing.
+        :param direction: The output direction.
+        :param size: The output size.
+        :param interpolation: A SimpleITK interpolator.
+        :param transform: Optional linear SimpleITK transform from output to input physical points.
+        :param default_value: The value of output voxels outside the input.
+        :param threads: Number of slabs resampled at once; defaults to the number of cores.
+        :param slab_voxels: Upper bound on the number of output voxels per slab.
+        :param output_path: If given, the output buffer is a memory-mapped NRRD file at this path
+                            instead of an in-memory array, so outputs larger than the RAM can be
+                            built.
+        :returns: The resampled SimpleITK image, or ``output_path`` if it was given.
+        """
         oldSize = image.GetSize()
-        newSize = [int(a * (b / c)) for a, b, c in zip(oldSize, oldSpacing, spacing)]
-        resampler = sitk.ResampleImageFilter()
-        resampler.SetInterpolator(interpolation)
-        resampler.SetOutputDirection(image.GetDirection())
-        resampler.SetOutputOrigin(image.GetOrigin())
-        resampler.SetOutputSpacing(spacing)
-        resampler.SetSize(newSize)
-        resampledImage = resampler.Execute(image)
+        threads = threads or os.cpu_count() or 1
+        reference = sitk.Image([1, 1, 1], image.GetPixelID())
+        reference.SetOrigin(origin); reference.SetSpacing(spacing); reference.SetDirection(direction)
+        thickness = max(1, min(-(-size[2]//(4*threads)), slab_voxels//max(1, size[0]*size[1])))
+        margin = ABLTemporalBoneSegmentationModuleLogic.get_interpolation_margin(interpolation, image.GetSpacing())
+
+        def resample_slab(z0):
+            slabSize = [size[0], size[1], min(thickness, size[2] - z0)]
+            resampler = sitk.ResampleImageFilter()
+            resampler.SetInterpolator(interpolation)
+            resampler.SetOutputDirection(direction)
+            resampler.SetOutputSpacing(spacing)
+            resampler.SetOutputOrigin(reference.TransformIndexToPhysicalPoint([0, 0, z0]))
+            resampler.SetSize(slabSize)
+            resampler.SetDefaultPixelValue(default_value)
+            if transform is not None: resampler.SetTransform(transform)
+            resampler.SetNumberOfThreads(1)
+            ## Find the input region the slab samples from; a linear transform maps its corners onto
+            ## the corners of that region
+            corners = [reference.TransformContinuousIndexToPhysicalPoint([-0.5 + i*slabSize[0], -0.5 + j*slabSize[1], z0 - 0.5 + k*slabSize[2]])
+                       for i in (0, 1) for j in (0, 1) for k in (0, 1)]
+            if transform is not None: corners = [transform.TransformPoint(c) for c in corners]
+            corners = [image.TransformPhysicalPointToContinuousIndex(c) for c in corners]
+            lower = [max(0, int(np.floor(min(c[d] for c in corners))) - margin[d]) for d in range(3)]
+            upper = [min(oldSize[d] - 1, int(np.ceil(max(c[d] for c in corners))) + margin[d]) for d in range(3)]
+            if any(u < l for l, u in zip(lower, upper)):
+                piece = image[0:1, 0:1, 0:1]
+            else:
+                piece = sitk.RegionOfInterest(image, [u - l + 1 for l, u in zip(lower, upper)], lower)
+            return z0, sitk.GetArrayFromImage(resampler.Execute(piece))
+
+        output = None
+        if output_path is not None:
+            dtype = sitk.GetArrayViewFromImage(image[0:1, 0:1, 0:1]).dtype
+            components = image.GetNumberOfComponentsPerPixel()
+            with open(output_path, 'wb') as f:
+                ABLTemporalBoneSegmentationModuleLogic.write_nrrd_header(f, size, origin, spacing, direction, components, dtype)
+                offset = f.tell()
+            shape = tuple(reversed(size)) + ((components,) if components > 1 else ())
+            output = np.memmap(output_path, dtype=dtype, mode='r+', offset=offset, shape=shape)
+        starts = list(range(0, size[2], thickness))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            ## Only keep a few slabs in flight so finished ones can't pile up behind a slow one
+            pending = [executor.submit(resample_slab, z0) for z0 in starts[:2*threads]]
+            starts = starts[2*threads:]
+            while pending:
+                z0, slab = pending.pop(0).result()
+                if starts: pending.append(executor.submit(resample_slab, starts.pop(0)))
+                if output is None: output = np.empty((size[2],) + slab.shape[1:], dtype=slab.dtype)
+                output[z0:z0 + slab.shape[0]] = slab
+                del slab
+        if output_path is not None:
+            output.flush()
+            del output
+            return output_path
+        resampledImage = sitk.GetImageFromArray(output, isVector=image.GetNumberOfComponentsPerPixel() > 1)
+        resampledImage.SetOrigin(origin)
+        resampledImage.SetSpacing(spacing)
+        resampledImage.SetDirection(direction)
         return resampledImage
 
     @staticmethod
-    def pull_node_resample_push(node, spacing_in_um, interpolation):
+    def pull_node_resample_push(node, spacing_in_um, interpolation, roi_node=None):
+        """Resample a volume into a new volume node.
+
+        :param roi_node: Optional ROI; only the part of the output inside it is computed, as if the
+                         resampled volume had then been cropped to the ROI's bounding box.
+        """
+        ## A registration applied without hardening would otherwise be ignored, as only the voxels are pulled
+        ABLTemporalBoneSegmentationModuleLogic.harden_transforms(node)
         image = sitku.PullVolumeFromSlicer(node.GetID())
-        resampledImage = ABLTemporalBoneSegmentationModuleLogic().resample_image(image, spacing_in_um, interpolation)
-        resampledNode = sitku.PushVolumeToSlicer(resampledImage, None, node.GetName() + "_Resampled" + str(spacing_in_um) + '', "vtkMRMLScalarVolumeNode")
+        name = node.GetName() + "_Resampled" + str(spacing_in_um) + ''
+        region = ABLTemporalBoneSegmentationModuleLogic.get_roi_region(image, spacing_in_um, roi_node) if roi_node is not None else None
+        size = ABLTemporalBoneSegmentationModuleLogic.estimate_resample_bytes(image, spacing_in_um, region)
+        budget = ABLTemporalBoneSegmentationModuleLogic.get_resample_memory_budget()
+        if size <= budget:
+            resampledImage = ABLTemporalBoneSegmentationModuleLogic().resample_image(image, spacing_in_um, interpolation, region=region)
+            return sitku.PushVolumeToSlicer(resampledImage, None, name, "vtkMRMLScalarVolumeNode")
+
+        ## Too large to build in memory next to the input; build it on disk and load the file, which
+        ## only needs memory for the volume itself. A volume larger than the RAM can't be loaded at all
+        try: ram = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+        except (AttributeError, ValueError, OSError): ram = None
+        if ram is not None and size > ram:
+            raise MemoryError("Resampling would produce %.1f GB, more than the %.1f GB of RAM" % (size/1024.0**3, ram/1024.0**3))
+        path = os.path.join(slicer.app.temporaryPath, re.sub(r'[^\w.-]', '_', name) + '.nrrd')
+        free = shutil.disk_usage(slicer.app.temporaryPath).free
+        if size > free:
+            raise MemoryError("Resampling would produce %.1f GB, more than the %.1f GB memory budget and the %.1f GB free in %s" %
+                              (size/1024.0**3, budget/1024.0**3, free/1024.0**3, slicer.app.temporaryPath))
+        logging.warning("Resampled volume of %.1f GB exceeds the %.1f GB memory budget, resampling to %s" % (size/1024.0**3, budget/1024.0**3, path))
+        ABLTemporalBoneSegmentationModuleLogic().resample_image(image, spacing_in_um, interpolation, output_path=path, region=region)
+        del image
+        resampledNode = slicer.util.loadVolume(path, {"name": name})
+        os.remove(path)
         return resampledNode
 
     @staticmethod
@@ -1296,55 +3069,326 @@ class ABLTemporalBoneSegmentationModuleLogic(ScriptedLoadableModuleLogic):
         return transformed_node
 
     @staticmethod
-    def apply_elastix_rigid_registration(elastix, atlas_node, moving_node, mask_node, log_callback, copy=True):
+    def count_resamples(node):
+        """How many times hardening a volume's transforms interpolates its voxels: once if any of
+        them is a grid or other non-linear transform, as linear ones only change its geometry."""
+        parent = node.GetParentTransformNode() if node is not None else None
+        return 0 if parent is None or parent.IsTransformToWorldLinear() else 1
+
+    @staticmethod
+    def harden_transforms(node):
+        """Harden any transforms a volume is still under, e.g. from a :class:`TransformChain`."""
+        if node is None or node.GetParentTransformNode() is None: return node
+        resamples = ABLTemporalBoneSegmentationModuleLogic.count_resamples(node)
+        node.HardenTransform()
+        logging.info("Hardened the transforms of %s (%s)" % (node.GetName(), "resampled" if resamples else "geometry only, no resample"))
+        return node
+
+    @staticmethod
+    def apply_registration_transform(node, transform_node):
+        """Resample the node through the given registration transform and discard the transform."""
+        node.ApplyTransform(transform_node.GetTransformToParent())
+        node.HardenTransform()
+        slicer.mrmlScene.RemoveNode(transform_node)
+        return node
+
+    @staticmethod
+    def crop_volume(input_node, roi_node, fill_value=-3000, interpolation_mode=2):
+        # copy input
+        outputVolumeNode = slicer.vtkMRMLScalarVolumeNode()
+        outputVolumeNode.Copy(input_node)
+        outputVolumeNode.SetName(input_node.GetName() + "_Crop")
+        slicer.mrmlScene.AddNode(outputVolumeNode)
+
+        # build and apply crop params
+        cropParams = slicer.vtkMRMLCropVolumeParametersNode()
+        cropParams.SetScene(slicer.mrmlScene)
+        cropParams.SetIsotropicResampling(False)
+        cropParams.SetInterpolationMode(interpolation_mode)
+        cropParams.SetFillValue(fill_value)
+        cropParams.SetInputVolumeNodeID(input_node.GetID())
+        cropParams.SetROINodeID(roi_node.GetID())
+        cropParams.SetOutputVolumeNodeID(outputVolumeNode.GetID())
+        slicer.modules.cropvolume.logic().Apply(cropParams)
+        return outputVolumeNode
+
+    @staticmethod
+    def crop_transformed_volume(input_node, roi_node, fill_value=-3000, interpolation=None):
+        """Crop a volume to an ROI, applying its unhardened parent transforms in the same pass.
+
+        Gives the same result as hardening the (linear) transforms and then running
+        :meth:`crop_volume`, but with a single interpolation over the ROI only and without copying
+        the input volume first.
+
+        :param input_node: The volume to crop; it may be under any chain of linear transforms.
+        :param roi_node: The ROI; the output covers its RAS bounding box at the input's spacing.
+        :param fill_value: The value of output voxels outside the input volume.
+        :param interpolation: A SimpleITK interpolator; linear if None.
+        :returns: The new, cropped volume node.
+        """
+        if interpolation is None: interpolation = sitk.sitkLinear
+        image = sitku.PullVolumeFromSlicer(input_node.GetID())
+        ## Map output (world) points back into the volume's untransformed space, in LPS
+        to_world = vtk.vtkMatrix4x4()
+        parent = input_node.GetParentTransformNode()
+        if parent is not None:
+            if not parent.IsTransformToWorldLinear(): raise ValueError("Only linear transforms can be applied while cropping")
+            parent.GetMatrixTransformToWorld(to_world)
+        lps_to_ras = np.diag([-1.0, -1.0, 1.0, 1.0])
+        to_input = lps_to_ras.dot(np.linalg.inv(slicer.util.arrayFromVTKMatrix(to_world))).dot(lps_to_ras)
+        transform = sitk.AffineTransform(3)
+        transform.SetMatrix(to_input[:3, :3].flatten().tolist())
+        transform.SetTranslation(to_input[:3, 3].tolist())
+
+        bounds = [0]*6
+        roi_node.GetRASBounds(bounds)
+        lower = [-bounds[1], -bounds[3], bounds[4]]
+        upper = [-bounds[0], -bounds[2], bounds[5]]
+        spacing = image.GetSpacing()
+        size = [max(1, int(round((u - l)/s))) for l, u, s in zip(lower, upper, spacing)]
+        origin = [l + s/2 for l, s in zip(lower, spacing)]
+        output = ABLTemporalBoneSegmentationModuleLogic.resample_to_grid(image, origin, spacing, [1, 0, 0, 0, 1, 0, 0, 0, 1], size, interpolation,
+                                                                         transform=transform, default_value=fill_value)
+        return sitku.PushVolumeToSlicer(output, None, input_node.GetName() + "_Crop", "vtkMRMLScalarVolumeNode")
+
+    @staticmethod
+    def build_roi(name, center=None, radius=None, reference_node=None):
+        """Create an ROI node, either from an explicit RAS center/radius or fitted to a reference node."""
+        roi_node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLAnnotationROINode', name)
+        if center is None or radius is None:
+            bounds = [0]*6
+            reference_node.GetRASBounds(bounds)
+            center = [(bounds[2*i] + bounds[2*i + 1])/2 for i in range(3)]
+            radius = [(bounds[2*i + 1] - bounds[2*i])/2 for i in range(3)]
+        roi_node.SetXYZ(center)
+        roi_node.SetRadiusXYZ(radius)
+        return roi_node
+    @staticmethod
+    def start_elastix_rigid_registration(elastix, atlas_node, moving_node, mask_node, log_callback, threads=None, use_cache=True, early_exit=False):
+        """Start a rigid registration of the moving volume to the atlas in the background.
+
+        If ``use_cache`` is set and the same volumes were registered with the same parameters
+        before, the cached transform is used and the returned job is already complete. If
+        ``early_exit`` is set, each resolution level stops as soon as its metric stops improving, which mostly pays
+        off after a good fiducial pre-alignment.
+
+        :returns: The started :class:`ElastixRegistrationJob`; poll it until it finishes, then pass
+                  it to :meth:`finish_elastix_rigid_registration`.
+        """
+        log_callback('Register volumes...')
+        ## Elastix reads the voxels and geometry as saved, without any transform the volume is still under
+        ABLTemporalBoneSegmentationModuleLogic.harden_transforms(moving_node)
+        return ElastixRegistrationJob(
+            elastix=elastix,
+            fixed_node=atlas_node,
+            moving_node=moving_node,
+            parameter_filenames=["Parameters_Rigid.txt"],
+            fixed_mask_node=mask_node,
+            moving_mask_node=mask_node,
+            log_callback=log_callback,
+            threads=threads,
+            cache=ABLTemporalBoneSegmentationModuleLogic.get_transform_cache() if use_cache else None,
+            input_store=ABLTemporalBoneSegmentationModuleLogic.get_elastix_input_store(elastix),
+            convergence=ConvergenceMonitor() if early_exit else None
+        ).start()
+
+    @staticmethod
+    def finish_elastix_rigid_registration(job, copy=True, harden=True):
+        """Apply a finished registration job's transform to its moving volume.
+
+        :param copy: Whether to output a new volume rather than transforming the moving volume.
+        :param harden: Whether to harden the transform. If not, the output only observes the
+                       transform, and a copy shares the moving volume's voxels instead of copying
+                       them; :meth:`crop_transformed_volume` can then apply it when cropping.
+                       Resampling or registering the output again hardens it first.
+        """
+        moving_node = job.moving_node
         outputVolumeNode = moving_node
+        if not harden:
+            if copy:
+                outputVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
+                outputVolumeNode.CopyOrientation(moving_node)
+                outputVolumeNode.SetAndObserveImageData(moving_node.GetImageData())
+                outputVolumeNode.CreateDefaultDisplayNodes()
+            outputVolumeNode.SetAndObserveTransformNodeID(job.transform_node.GetID())
+            outputVolumeNode.SetName(moving_node.GetName() + "_Elastix")
+            return outputVolumeNode
         if copy:
             outputVolumeNode = slicer.vtkMRMLScalarVolumeNode()
             outputVolumeNode.Copy(moving_node)
-            outputVolumeNode.SetName(moving_node.GetName() + "_Elastix")
-        transform_node = slicer.vtkMRMLTransformNode()
-        transform_node.SetName(moving_node.GetName() + ' Elastix transform')
-        slicer.mrmlScene.AddNode(transform_node)
-        elastix.registrationParameterFilesDir = slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/Resources/Parameters/'
-        elastix.logStandardOutput = True
-        elastix.logCallback = log_callback
-        elastix.registerVolumes(
-            fixedVolumeNode=atlas_node,
-            movingVolumeNode=moving_node,
-            parameterFilenames={"Parameters_Rigid.txt"},
-            # outputVolumeNode=outputVolumeNode,
-            outputTransformNode=transform_node,
-            fixedVolumeMaskNode=mask_node,
-            movingVolumeMaskNode=mask_node
-        )
-        print('TRANSFORM GENERATED: '); print(transform_node)
-        outputVolumeNode.ApplyTransform(transform_node.GetTransformToParent())
-        outputVolumeNode.HardenTransform()
+        print('TRANSFORM GENERATED: '); print(job.transform_node)
+        ABLTemporalBoneSegmentationModuleLogic.apply_registration_transform(outputVolumeNode, job.transform_node)
         outputVolumeNode.SetName(moving_node.GetName() + "_Elastix")
         slicer.mrmlScene.AddNode(outputVolumeNode)
         return outputVolumeNode
 
     @staticmethod
-    def process_rigid_progress(text):
-        progress = None
-        if text.startswith('Register volumes'): progress = 1
-        elif text.startswith('-fMask'): progress = 3
-        elif text.startswith('Reading images'): progress = 7
-        elif text.startswith('Time spent in resolution 0'): progress = 14
-        elif text.startswith('Time spent in resolution 1'): progress = 40
-        elif text.startswith('Time spent in resolution 2'): progress = 60
-        elif text.startswith('Time spent in resolution 3'): progress = 80
-        elif text.startswith('Applying final transform'): progress = 85
-        elif text.startswith('Time spent on saving the results'): progress = 90
-        elif text.startswith('Generate output'): progress = 93
-        elif text.startswith('Reading input image'): progress = 94
-        elif text.startswith('Resampling image and writing to disk'): progress = 96
-        elif text.startswith('Registration is completed'): progress = 100
-        return progress
+    def apply_elastix_rigid_registration(elastix, atlas_node, moving_node, mask_node, log_callback, copy=True):
+        job = ABLTemporalBoneSegmentationModuleLogic.start_elastix_rigid_registration(elastix, atlas_node, moving_node, mask_node, log_callback)
+        job.wait()
+        return ABLTemporalBoneSegmentationModuleLogic.finish_elastix_rigid_registration(job, copy=copy)
+
+    @staticmethod
+    def get_parameter_files_dir():
+        return slicer.os.path.dirname(slicer.os.path.abspath(inspect.getfile(inspect.currentframe()))) + '/Resources/Parameters/'
+
+    @staticmethod
+    def read_elastix_parameters(path):
+        """Read an Elastix parameter or transform parameter file.
+
+        :param path: The file to read.
+        :returns: A dict mapping each key to its list of values; quoted values are returned as
+                  strings and everything else as floats.
+        """
+        parameters = {}
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.split('//', 1)[0].strip()
+                if not line.startswith('(') or not line.endswith(')'): continue
+                tokens = re.findall(r'"[^"]*"|\S+', line[1:-1])
+                values = []
+                for t in tokens[1:]:
+                    if t.startswith('"'): values.append(t[1:-1])
+                    else:
+                        try: values.append(float(t))
+                        except ValueError: values.append(t)
+                parameters[tokens[0]] = values
+        return parameters
+
+    @staticmethod
+    def write_elastix_parameters(source, destination, overrides):
+        """Copy an Elastix parameter file, replacing or adding the given parameters.
+
+        :param source: The parameter file to copy.
+        :param destination: Where to write the modified copy.
+        :param overrides: Maps parameter names to their new value or list of values; strings are
+                          quoted, numbers are written as is.
+        :returns: ``destination``.
+        """
+        def format_value(v):
+            return '"%s"' % v if isinstance(v, str) else repr(v)
+        remaining = dict(overrides)
+        lines = []
+        with open(source, 'r') as f:
+            for line in f:
+                m = re.match(r'\s*\((\w+)\s', line)
+                if m is not None and m.group(1) in remaining:
+                    values = remaining.pop(m.group(1))
+                    values = values if isinstance(values, (list, tuple)) else [values]
+                    line = '(%s %s)\n' % (m.group(1), ' '.join(format_value(v) for v in values))
+                lines.append(line)
+        for key, values in remaining.items():
+            values = values if isinstance(values, (list, tuple)) else [values]
+            lines.append('(%s %s)\n' % (key, ' '.join(format_value(v) for v in values)))
+        with open(destination, 'w') as f:
+            f.writelines(lines)
+        return destination
+
+    @staticmethod
+    def elastix_parameters_to_matrix(path):
+        """Convert an Elastix linear transform parameter file into a homogeneous matrix.
+
+        Any chained initial transforms are composed in, as Elastix does when applying the file. The
+        returned matrix maps fixed image points to moving image points in LPS coordinates.
+
+        :param path: The TransformParameters file written by Elastix.
+        :returns: A 4x4 numpy array.
+        """
+        p = ABLTemporalBoneSegmentationModuleLogic.read_elastix_parameters(path)
+        transform = p['Transform'][0]
+        values = [float(v) for v in p['TransformParameters']]
+        center = np.array([float(v) for v in p.get('CenterOfRotationPoint', [0, 0, 0])])
+        if transform == 'EulerTransform':
+            (ax, ay, az), translation = values[:3], np.array(values[3:6])
+            rx = np.array([[1, 0, 0], [0, np.cos(ax), -np.sin(ax)], [0, np.sin(ax), np.cos(ax)]])
+            ry = np.array([[np.cos(ay), 0, np.sin(ay)], [0, 1, 0], [-np.sin(ay), 0, np.cos(ay)]])
+            rz = np.array([[np.cos(az), -np.sin(az), 0], [np.sin(az), np.cos(az), 0], [0, 0, 1]])
+            zyx = p.get('ComputeZYX', ['false'])[0] == 'true'
+            linear = rz.dot(ry).dot(rx) if zyx else rz.dot(rx).dot(ry)
+        elif transform == 'AffineTransform':
+            linear, translation = np.array(values[:9]).reshape(3, 3), np.array(values[9:12])
+        elif transform == 'TranslationTransform':
+            linear, translation = np.identity(3), np.array(values[:3])
+        else:
+            raise ValueError("Unsupported Elastix transform \"%s\"" % transform)
+        matrix = np.identity(4)
+        matrix[:3, :3] = linear
+        matrix[:3, 3] = center + translation - linear.dot(center)
+
+        initial = p.get('InitialTransformParametersFileName', ['NoInitialTransform'])[0]
+        if initial != 'NoInitialTransform':
+            if not os.path.isabs(initial): initial = os.path.join(os.path.dirname(path), initial)
+            ## Elastix composes as T(x) = T_current(T_initial(x))
+            matrix = matrix.dot(ABLTemporalBoneSegmentationModuleLogic.elastix_parameters_to_matrix(initial))
+        return matrix
+
+    @staticmethod
+    def matrix_to_transform_node(matrix, name):
+        """Create a linear transform node from an Elastix-style fixed-to-moving LPS matrix."""
+        ## Elastix works in LPS and maps fixed points to moving points, i.e. "from parent" in RAS
+        lps_to_ras = np.diag([-1, -1, 1, 1])
+        transform_node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', name)
+        transform_node.SetMatrixTransformFromParent(slicer.util.vtkMatrixFromArray(lps_to_ras.dot(matrix).dot(lps_to_ras)))
+        return transform_node
+
+    @staticmethod
+    def hash_volume(node):
+        """Hash a volume's voxels and geometry, reusing the last hash while its image is unmodified."""
+        image = node.GetImageData()
+        memo = ABLTemporalBoneSegmentationModuleLogic._volumeHashes.get(node.GetID())
+        stamp = (image.GetMTime(), node.GetMTime())
+        if memo is not None and memo[0] == stamp: return memo[1]
+        h = hashlib.sha256()
+        h.update(np.ascontiguousarray(slicer.util.arrayFromVolume(node)).data)
+        matrix = vtk.vtkMatrix4x4()
+        node.GetIJKToRASMatrix(matrix)
+        h.update(str([matrix.GetElement(i, j) for i in range(4) for j in range(4)]).encode())
+        digest = h.hexdigest()
+        ABLTemporalBoneSegmentationModuleLogic._volumeHashes[node.GetID()] = (stamp, digest)
+        return digest
+
+    @staticmethod
+    def get_elastix_logic():
+        """The shared ``Elastix.ElastixLogic``, created (and SlicerElastix imported) on first use."""
+        if ABLTemporalBoneSegmentationModuleLogic._elastixLogic is None:
+            import Elastix
+            ABLTemporalBoneSegmentationModuleLogic._elastixLogic = Elastix.ElastixLogic()
+        return ABLTemporalBoneSegmentationModuleLogic._elastixLogic
+
+    @staticmethod
+    def clear_elastix_input_store():
+        if ABLTemporalBoneSegmentationModuleLogic._elastixInputStore is not None:
+            ABLTemporalBoneSegmentationModuleLogic._elastixInputStore.clear()
+
+    @staticmethod
+    def get_elastix_input_store(elastix):
+        """The session's store of volumes already serialized for Elastix."""
+        if ABLTemporalBoneSegmentationModuleLogic._elastixInputStore is None:
+            directory = os.path.join(elastix.getTempDirectoryBase(), "SharedInputs-%d" % os.getpid())
+            ABLTemporalBoneSegmentationModuleLogic._elastixInputStore = ElastixInputStore(directory)
+        return ABLTemporalBoneSegmentationModuleLogic._elastixInputStore
+
+    @staticmethod
+    def get_transform_cache():
+        """The persistent cache of rigid registration results, shared by both modules."""
+        if ABLTemporalBoneSegmentationModuleLogic._transformCache is None:
+            max_mb = float(slicer.app.settings().value("ABLTemporalBoneSegmentation/TransformCacheMaxMB", 10))
+            directory = os.path.join(slicer.app.cachePath, "ABLTemporalBoneSegmentation", "Transforms")
+            ABLTemporalBoneSegmentationModuleLogic._transformCache = DiskCache(directory, int(max_mb*1024*1024))
+        return ABLTemporalBoneSegmentationModuleLogic._transformCache
+
+    @staticmethod
+    def get_pyramid_factors(parameter_file):
+        """The per-level shrink factors of a parameter file's image pyramid, coarsest first."""
+        parameters = ABLTemporalBoneSegmentationModuleLogic.read_elastix_parameters(parameter_file)
+        n = int(parameters.get('NumberOfResolutions', [4])[0])
+        schedule = parameters.get('FixedImagePyramidSchedule', parameters.get('ImagePyramidSchedule'))
+        if schedule is not None and len(schedule) == 3*n: return [int(schedule[3*i]) for i in range(n)]
+        return [2**(n - i - 1) for i in range(n)]
 
     @staticmethod
-    def attempt_abort_rigid_registration(elastix):
-        elastix.abortRequested = True
+    def attempt_abort_rigid_registration(job):
+        job.cancel()
 
     @staticmethod
     def open_save_node_dialog(node):
@@ -1357,19 +3401,182 @@ class ABLTemporalBoneSegmentationModuleLogic(ScriptedLoadableModuleLogic):
         dialog.selectFile(name)
         dialog.setAcceptMode(qt.QFileDialog.AcceptSave)
         if dialog.exec_() != qt.QDialog.Accepted: return
+        ABLTemporalBoneSegmentationModuleLogic.harden_transforms(node)
         o = slicer.util.saveNode(node=node, filename=dialog.selectedFiles()[0] + next(t for t in supportedSaveTypes if t["title"] == dialog.selectedNameFilter())['value'])
 
     @staticmethod
-    def run_inference(config, model, model_config, dispatch=SlicerDispatchDocker, progress=lambda *args: None, get_model=False):
-        dispatch = dispatch(config)
+    def load_inference_model():
+        with open(os.path.join(os.path.dirname(__file__), "Resources", "Models", "ABLTempSeg.json"), 'r') as f:
+            return json.load(f)
+
+    @staticmethod
+    def build_inference_config(remote, host=None, username=None, password=None, docker_host=None):
+        """Assemble the ABLInfer dispatch configuration.
+
+        :param remote: Whether to dispatch to a remote ABLInfer server rather than local Docker.
+        :param host: The remote server's base URL.
+        :param username: The remote server username, if any.
+        :param password: The remote server password, if any.
+        :param docker_host: The Docker daemon location; the environment default is used if empty.
+        :returns: A tuple of the configuration and the dispatch class to use.
+        """
+        ablinfer = import_ablinfer()
+        config = {
+            "tmp_path": os.path.join(os.path.expanduser("~"), ".ablinfer")
+        }
+
+        if not os.path.isdir(config["tmp_path"]):
+            os.makedirs(config["tmp_path"])
+
+        if remote:
+            config["base_url"] = host
+            config["session"] = ABLTemporalBoneSegmentationModuleLogic.get_remote_client(host, username, password).session
+            return config, ablinfer.slicer.SlicerDispatchRemote
+
+        if docker_host:
+            config["docker"] = {"base_url": docker_host}
+        return config, ablinfer.slicer.SlicerDispatchDocker
+
+    @staticmethod
+    def get_remote_client(host, username=None, password=None):
+        """The session-wide :class:`RemoteClient` for a server; a new one replaces it if the credentials changed."""
+        clients = ABLTemporalBoneSegmentationModuleLogic._remoteClients
+        credentials = (username, password) if username else None
+        if host in clients and clients[host].credentials != credentials:
+            clients.pop(host).close()
+        if host not in clients: clients[host] = RemoteClient(host, username, password)
+        return clients[host]
+
+    @staticmethod
+    def close_remote_clients():
+        for client in ABLTemporalBoneSegmentationModuleLogic._remoteClients.values(): client.close()
+        ABLTemporalBoneSegmentationModuleLogic._remoteClients = {}
 
-        if get_model and isinstance(dispatch, DispatchRemote): ## Try to retrieve the model from the remote server
+    @staticmethod
+    def build_model_config(input_node, good_volume=False, smoothing=0.5):
+        return {
+            "inputs": {
+                "input_vol": {
+                    "value": input_node,
+                },
+            },
+            "outputs": {
+                "input_vol_resampled": {
+                    "enabled": good_volume,
+                    "value": None,
+                },
+                "output_seg": {
+                    "value": None,
+                    "enabled": True,
+                    "post": [
+                        { ## Island removal (done in container)
+                            "enabled": False,
+                        },
+                        { ## Show result
+                            "enabled": True,
+                            "params": {
+                                "smoothing": smoothing,
+                            },
+                        },
+                    ],
+                },
+            },
+        }
+
+    @staticmethod
+    def run_inference(config, model, model_config, dispatch=None, progress=lambda *args: None, get_model=False, use_cache=True):
+        """Run the model, or load its result from the inference cache if this input was already segmented.
+
+        :param use_cache: Whether to look up and store the result in :meth:`get_inference_cache`.
+        """
+        ablinfer = import_ablinfer()
+        cache = key = None
+        if use_cache:
+            cache = ABLTemporalBoneSegmentationModuleLogic.get_inference_cache(config["tmp_path"])
+            key = ABLTemporalBoneSegmentationModuleLogic.compute_inference_key(model, model_config)
+            entry = cache.get(key)
+            if entry is not None:
+                try:
+                    ABLTemporalBoneSegmentationModuleLogic.load_inference_result(entry, model_config)
+                    progress(ablinfer.constants.DispatchStage.Postprocess, 1, 1, "Loaded cached result " + key[:12])
+                    return None
+                except Exception as e:
+                    logging.warning("Discarding unreadable cached inference result %s: %s" % (key[:12], e))
+                    cache.remove(key)
+        dispatch = (dispatch or ablinfer.slicer.SlicerDispatchDocker)(config)
+
+        if get_model and isinstance(dispatch, ablinfer.remote.DispatchRemote): ## Try to retrieve the model from the remote server
             try:
-                model = dispatch.get_model(model["id"])
+                client = ABLTemporalBoneSegmentationModuleLogic._remoteClients.get(config["base_url"])
+                model = client.get_model(model["id"]) if client is not None else dispatch.get_model(model["id"])
             except Exception as e:
                 logging.warning("Encountered an error retrieving model from remote: " + str(e))
 
-        return dispatch.run(model, model_config, progress=progress)
+        result = dispatch.run(model, model_config, progress=progress)
+        if cache is not None:
+            try:
+                if cache.put(key, lambda directory: ABLTemporalBoneSegmentationModuleLogic.save_inference_result(directory, model_config)) is None:
+                    logging.warning("The inference result is larger than the inference cache (InferenceCacheMaxMB), it was not cached")
+            except Exception as e: logging.warning("Could not cache the inference result: " + str(e))
+        return result
+
+    @staticmethod
+    def get_inference_cache(tmp_path):
+        """The persistent cache of inference results, kept in ABLInfer's working directory."""
+        directory = os.path.join(tmp_path, "results")
+        cache = ABLTemporalBoneSegmentationModuleLogic._inferenceCache
+        if cache is None or cache.directory != directory:
+            max_mb = float(slicer.app.settings().value("ABLTemporalBoneSegmentation/InferenceCacheMaxMB", 2048))
+            cache = ABLTemporalBoneSegmentationModuleLogic._inferenceCache = DiskCache(directory, int(max_mb*1024*1024))
+        return cache
+
+    @staticmethod
+    def compute_inference_key(model, model_config):
+        """Hash everything an inference result depends on: the input voxels and geometry, the model's id and
+        version and the model configuration. Smoothing only affects how the result is displayed, so it is left out
+        and applied again when a cached result is loaded."""
+        def options(value):
+            if isinstance(value, dict): return {k: options(v) for k, v in value.items() if k not in ("value", "smoothing")}
+            if isinstance(value, list): return [options(v) for v in value]
+            return value
+        h = hashlib.sha256()
+        for name, spec in sorted(model_config["inputs"].items()):
+            h.update(name.encode())
+            h.update(ABLTemporalBoneSegmentationModuleLogic.hash_volume(spec["value"]).encode())
+        h.update(json.dumps([model.get("id"), model.get("version"), options(model_config)], sort_keys=True).encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def save_inference_result(directory, model_config):
+        names = {}
+        for name, spec in model_config["outputs"].items():
+            node = spec.get("value")
+            if not spec.get("enabled", True) or node is None: continue
+            extension = ".seg.nrrd" if node.IsA("vtkMRMLSegmentationNode") else ".nrrd"
+            slicer.util.saveNode(node, os.path.join(directory, name + extension))
+            names[name] = (node.GetName(), extension)
+        with open(os.path.join(directory, "outputs.json"), "w") as f:
+            json.dump(names, f)
+
+    @staticmethod
+    def load_inference_result(directory, model_config):
+        """Load a cached result into new nodes and fill them into the model configuration's outputs, as a run would."""
+        with open(os.path.join(directory, "outputs.json"), "r") as f:
+            names = json.load(f)
+        outputs = model_config["outputs"]
+        missing = [name for name, spec in outputs.items() if spec.get("enabled", True) and name not in names]
+        if missing: raise Exception("no cached " + ", ".join(missing))
+        for name, (node_name, extension) in names.items():
+            if name not in outputs or not outputs[name].get("enabled", True): continue
+            path = os.path.join(directory, name + extension)
+            node = slicer.util.loadSegmentation(path) if extension == ".seg.nrrd" else slicer.util.loadVolume(path)
+            node.SetName(node_name)
+            for op in outputs[name].get("post", []):
+                if op.get("enabled") and "smoothing" in op.get("params", {}):
+                    node.GetSegmentation().SetConversionParameter("Smoothing factor", str(op["params"]["smoothing"]))
+                    node.RemoveClosedSurfaceRepresentation()
+                    node.CreateClosedSurfaceRepresentation()
+            outputs[name]["value"] = node
     
     @staticmethod
     def export_for_cardinalsim(volume, segmentation, directory, labels=None):
@@ -1454,3 +3661,202 @@ class ABLTemporalBoneSegmentationModuleLogic(ScriptedLoadableModuleLogic):
 
         ## Clean up the labelmap
         slicer.mrmlScene.RemoveNode(labelmap)
+
+    @staticmethod
+    def run_batch_manifest(manifest_path, log=print):
+        """Run the full segmentation pipeline on every scan listed in a manifest, without any widgets.
+
+        The manifest is a JSON file of the form::
+
+            {
+                "output_directory": "out",
+                "defaults": {"export_cardinalsim": true},
+                "inference": {"remote": false, "docker_host": "", "server": "", "username": "", "password": ""},
+                "scans": [
+                    {"volume": "scan01.nrrd", "side": "L", "fiducials": "scan01_fiducials.fcsv"},
+                    ...
+                ]
+            }
+
+        Per-scan keys (any of which may also be given in ``defaults``) are ``volume``, ``side``
+        (``L`` or ``R``), ``fiducials`` (a markups file whose labels match the atlas fiducials),
+        ``spacing_um`` (optional resample spacing), ``interpolation`` (a resample interpolation
+        title), ``roi`` (optional ``{"center": [...], "radius": [...]}`` in RAS; the atlas extent
+        is used otherwise), ``rigid`` (whether to run Elastix), ``early_exit`` (stop each Elastix
+        resolution once converged), ``infer``, ``good_volume`` and ``export_cardinalsim``. Relative paths are resolved against the manifest's directory.
+
+        :param manifest_path: The manifest file.
+        :param log: Called with each progress message.
+        :returns: A list with one ``(volume, error)`` tuple per scan; ``error`` is None on success.
+        """
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        base = os.path.dirname(os.path.abspath(manifest_path))
+        def resolve(path):
+            return path if path is None or os.path.isabs(path) else os.path.join(base, path)
+
+        output_directory = resolve(manifest.get("output_directory", "output"))
+        defaults = {"rigid": True, "early_exit": False, "infer": True, "good_volume": False, "export_cardinalsim": False, "interpolation": "B-spline"}
+        defaults.update(manifest.get("defaults", {}))
+        inference = manifest.get("inference", {})
+        elastix = ABLTemporalBoneSegmentationModuleLogic.get_elastix_logic()
+        atlases = {}
+        results = []
+        for n, entry in enumerate(manifest["scans"], 1):
+            scan = dict(defaults, **entry)
+            for key in ("volume", "fiducials"): scan[key] = resolve(scan.get(key))
+            log("[%d/%d] %s" % (n, len(manifest["scans"]), scan["volume"]))
+            side = scan["side"].upper()
+            if side not in atlases:
+                atlases[side] = ABLTemporalBoneSegmentationModuleLogic.load_atlas_and_fiducials_and_mask(side, show_progress=False)
+            ## Remove everything this scan adds to the scene once it's done, so memory stays bounded
+            existing = ABLTemporalBoneSegmentationModuleLogic.get_scene_node_ids()
+            try:
+                ABLTemporalBoneSegmentationModuleLogic.run_pipeline(scan, atlases[side], elastix, inference, output_directory, log)
+                results.append((scan["volume"], None))
+            except Exception as e:
+                traceback.print_exc()
+                log("Failed: %s" % e)
+                results.append((scan["volume"], e))
+            finally:
+                for node_id in ABLTemporalBoneSegmentationModuleLogic.get_scene_node_ids() - existing:
+                    node = slicer.mrmlScene.GetNodeByID(node_id)
+                    if node is not None: slicer.mrmlScene.RemoveNode(node)
+        ABLTemporalBoneSegmentationModuleLogic.get_elastix_input_store(elastix).clear()
+        log("Finished %d of %d scan(s)" % (sum(1 for _, e in results if e is None), len(results)))
+        return results
+
+    @staticmethod
+    def get_scene_node_ids():
+        return {slicer.mrmlScene.GetNthNode(i).GetID() for i in range(slicer.mrmlScene.GetNumberOfNodes())}
+
+    @staticmethod
+    def run_pipeline(scan, atlas, elastix, inference, output_directory, log=print):
+        """Run every step of the pipeline on a single scan; see :meth:`run_batch_manifest`."""
+        atlas_node, atlas_fiducial_node, mask_node = atlas
+        node = slicer.util.loadVolume(scan["volume"])
+        name = node.GetName()
+        scan_directory = os.path.join(output_directory, name)
+        os.makedirs(scan_directory, exist_ok=True)
+
+        if scan.get("spacing_um"):
+            log("Resampling...")
+            interpolation = getattr(sitk, next(i["value"] for i in supportedResampleInterpolations if i["title"] == scan["interpolation"]))
+            node = ABLTemporalBoneSegmentationModuleLogic.pull_node_resample_push(node, [float(i)/1000 for i in scan["spacing_um"]], interpolation)
+
+        log("Fiducial registration...")
+        input_fiducial_node = slicer.util.loadMarkups(scan["fiducials"])
+        node = ABLTemporalBoneSegmentationModuleLogic.apply_fiducial_registration(node, atlas_fiducial_node, input_fiducial_node)
+        node = ABLTemporalBoneSegmentationModuleLogic.harden_fiducial_registration(node)
+
+        if scan["rigid"]:
+            log("Rigid registration...")
+            job = ABLTemporalBoneSegmentationModuleLogic.start_elastix_rigid_registration(elastix, atlas_node, node, mask_node, log_callback=logging.debug, early_exit=scan["early_exit"])
+            node = ABLTemporalBoneSegmentationModuleLogic.apply_registration_transform(node, job.wait())
+            if job.parser is not None: job.parser.write_csv(os.path.join(scan_directory, "rigid_metric.csv"))
+
+        log("Cropping...")
+        roi = scan.get("roi") or {}
+        roi_node = ABLTemporalBoneSegmentationModuleLogic.build_roi(name + " ROI", roi.get("center"), roi.get("radius"), reference_node=atlas_node)
+        node = ABLTemporalBoneSegmentationModuleLogic.crop_volume(node, roi_node)
+        slicer.util.saveNode(node, os.path.join(scan_directory, node.GetName() + ".nrrd"))
+
+        if not scan["infer"]:
+            return
+        log("Inference...")
+        model = ABLTemporalBoneSegmentationModuleLogic.load_inference_model()
+        config, dispatch = ABLTemporalBoneSegmentationModuleLogic.build_inference_config(
+            remote=bool(inference.get("remote")),
+            host=inference.get("server"),
+            username=inference.get("username"),
+            password=inference.get("password"),
+            docker_host=inference.get("docker_host"),
+        )
+        model_config = ABLTemporalBoneSegmentationModuleLogic.build_model_config(node, bool(scan["good_volume"]))
+        def progress(stage, f1, f2, text):
+            if stage != import_ablinfer().constants.DispatchStage.Run: log(text)
+        ABLTemporalBoneSegmentationModuleLogic.run_inference(config, model, model_config, dispatch=dispatch, progress=progress, get_model=True)
+        if scan["good_volume"]:
+            node = model_config["outputs"]["input_vol_resampled"]["value"]
+            slicer.util.saveNode(node, os.path.join(scan_directory, node.GetName() + ".nrrd"))
+        segmentation = model_config["outputs"]["output_seg"]["value"]
+        slicer.util.saveNode(segmentation, os.path.join(scan_directory, name + "_Segmentation.seg.nrrd"))
+
+        if scan["export_cardinalsim"]:
+            log("Exporting for CardinalSim...")
+            ABLTemporalBoneSegmentationModuleLogic.export_for_cardinalsim(node, segmentation, os.path.join(scan_directory, "CardinalSim"))
+
+
+def measure_module_import(name, paths=()):
+    """Time the import of a module in a fresh Slicer process.
+
+    Within the running application the dependencies are already loaded, so the import is measured
+    in a new Slicer without a main window or any scripted modules.
+
+    :param name: The module to import.
+    :param paths: Directories to add to the module search path, besides this module's.
+    :returns: The import time in seconds and the list of lazily imported dependencies (see
+              ``lazyModules``) that the import pulled in.
+    """
+    paths = [os.path.dirname(os.path.abspath(__file__))] + list(paths)
+    code = "\n".join([
+        "import importlib, json, sys, time",
+        "sys.path[:0] = %r" % paths,
+        "before = set(sys.modules)",
+        "start = time.perf_counter()",
+        "importlib.import_module(%r)" % name,
+        "elapsed = time.perf_counter() - start",
+        "print('IMPORT-TIME ' + json.dumps([elapsed, [m for m in %r if m not in before and m in sys.modules]]))" % (lazyModules,),
+        "slicer.util.exit(0)",
+    ])
+    result = subprocess.run([slicer.app.applicationFilePath(), "--no-splash", "--no-main-window", "--ignore-slicerrc",
+                             "--disable-scripted-loadable-modules", "--python-code", code],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=600)
+    for line in result.stdout.splitlines():
+        if line.startswith('IMPORT-TIME '):
+            elapsed, loaded = json.loads(line[len('IMPORT-TIME '):])
+            return elapsed, loaded
+    raise RuntimeError("Could not measure the import of %s:\n%s" % (name, result.stdout))
+
+
+class ABLTemporalBoneSegmentationModuleTest(ScriptedLoadableModuleTest):
+    def setUp(self):
+        slicer.mrmlScene.Clear(0)
+
+    def runTest(self):
+        self.setUp()
+        self.test_startup_budget()
+        self.test_resample_benchmark()
+
+    def test_startup_budget(self):
+        self.delayDisplay("Measuring the module import time")
+        elapsed, loaded = measure_module_import("ABLTemporalBoneSegmentationModule")
+        self.assertEqual(loaded, [], "Imported on the startup path: " + ", ".join(loaded))
+        self.assertLess(elapsed, startupBudget, "Importing took %.3f s" % elapsed)
+        self.delayDisplay("Imported in %.3f s (budget %.3f s)" % (elapsed, startupBudget))
+
+    def test_resample_benchmark(self):
+        self.delayDisplay("Comparing slab-parallel resampling with a single Resample")
+        image = sitk.Cast(sitk.AdditiveGaussianNoise(sitk.Image([96, 96, 96], sitk.sitkFloat32), 100, 0, 42), sitk.sitkFloat32)
+        image.SetSpacing([0.06, 0.06, 0.06])
+        for title, interpolation, tolerance in (("Linear", sitk.sitkLinear, 1e-3), ("Gaussian", sitk.sitkGaussian, 1e-3), ("B-spline", sitk.sitkBSpline, 1e-1)):
+            result = ABLTemporalBoneSegmentationModuleLogic.benchmark_resample(image, [0.05, 0.05, 0.05], interpolation, repeats=1)
+            self.assertLess(result['max_difference'], tolerance, title)
+            self.delayDisplay("%s: slabs %.2f s, Resample %.2f s, largest difference %g" % (title, result['slabs'], result['resample'], result['max_difference']))
+
+
+def main(argv):
+    """Headless entry point, e.g.::
+
+        Slicer --no-main-window --python-script ABLTemporalBoneSegmentationModule.py manifest.json
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the ABL temporal bone segmentation pipeline on a manifest of scans.")
+    parser.add_argument("manifest", help="JSON manifest listing the scans to process")
+    args = parser.parse_args(argv)
+    results = ABLTemporalBoneSegmentationModuleLogic.run_batch_manifest(args.manifest)
+    slicer.util.exit(0 if all(e is None for _, e in results) else 1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
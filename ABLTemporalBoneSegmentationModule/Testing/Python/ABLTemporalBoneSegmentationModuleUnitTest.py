@@ -0,0 +1,554 @@
+import base64
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import requests
+import requests.adapters
+import SimpleITK as sitk
+import slicer
+import urllib3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import ABLTemporalBoneSegmentationModule as module
+
+Logic = module.ABLTemporalBoneSegmentationModuleLogic
+
+
+def write_file(directory, name, text):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write(text)
+    return path
+
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ElastixProgressParserTest(TemporaryDirectoryTestCase):
+    def test_levels_from_parameters(self):
+        single = write_file(self.directory, "single.txt", "(NumberOfResolutions 4)\n(MaximumNumberOfIterations 250)\n")
+        schedule = write_file(self.directory, "schedule.txt", "(NumberOfResolutions 3)\n// (MaximumNumberOfIterations 1)\n(MaximumNumberOfIterations 100 200)\n")
+        self.assertEqual(module.ElastixProgressParser.levels_from_parameters([single]), [250]*4)
+        self.assertEqual(module.ElastixProgressParser.levels_from_parameters([single, schedule]), [250]*4 + [100, 200, 200])
+
+    def test_progress_over_levels(self):
+        parser = module.ElastixProgressParser([100, 200], setup=0.05, finish=0.05)
+        self.assertEqual(parser.progress(), 0.0)
+        self.assertIsNone(parser.feed("Resolution: 0"))
+        self.assertIsNone(parser.feed("1:ItNr\t2:Metric\t3a:Time"))
+        self.assertEqual(parser.feed("0\t-0.5\t0.1"), -0.5)
+        self.assertAlmostEqual(parser.progress(), 0.05 + 0.9*1/300)
+        ## The first level ends early; it counts as complete once the next one starts
+        parser.feed("49\t-0.6\t0.1")
+        parser.feed("Resolution: 1")
+        parser.feed("9\t-0.7\t0.1")
+        self.assertAlmostEqual(parser.progress(), 0.05 + 0.9*110/300)
+        parser.feed("Registration is completed.")
+        self.assertEqual(parser.progress(), 1.0)
+        self.assertEqual([(level, iteration, metric) for level, iteration, metric, _ in parser.history], [(0, 0, -0.5), (0, 49, -0.6), (1, 9, -0.7)])
+
+    def test_unparsable_rows(self):
+        parser = module.ElastixProgressParser([10])
+        parser.feed("Resolution: 0")
+        self.assertIsNone(parser.feed("3\tnan-ish\t0.1"))
+        self.assertIsNone(parser.feed("Time spent in resolution 0: 1.5"))
+        self.assertEqual(parser.history, [])
+
+    def test_eta(self):
+        parser = module.ElastixProgressParser([100])
+        parser.feed("Resolution: 0")
+        for i in range(9): parser.feed("%d\t-0.5\t0.1" % i)
+        self.assertIsNone(parser.eta())
+        parser.feed("9\t-0.5\t0.1")
+        self.assertGreaterEqual(parser.eta(), 0.0)
+        self.assertEqual(module.ElastixProgressParser.format_eta(75), "1:15 left")
+        self.assertEqual(module.ElastixProgressParser.format_eta(None), "")
+
+    def test_write_csv(self):
+        parser = module.ElastixProgressParser([10])
+        parser.feed("Resolution: 0")
+        parser.feed("0\t-0.25\t0.1")
+        path = os.path.join(self.directory, "metric.csv")
+        parser.write_csv(path)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], "level,iteration,metric,seconds")
+        self.assertTrue(lines[1].startswith("0,0,-0.25,"))
+
+
+class ConvergenceMonitorTest(unittest.TestCase):
+    def test_never_stops_before_min_iterations(self):
+        monitor = module.ConvergenceMonitor(window=25, threshold=1e-3, min_iterations=50)
+        self.assertEqual([monitor.add(1.0) for _ in range(49)], [False]*49)
+        self.assertTrue(monitor.add(1.0))
+
+    def test_min_iterations_covers_two_windows(self):
+        monitor = module.ConvergenceMonitor(window=40, min_iterations=10)
+        self.assertEqual(monitor.min_iterations, 80)
+        self.assertFalse(any(monitor.add(1.0) for _ in range(79)))
+        self.assertTrue(monitor.add(1.0))
+
+    def test_improving_metric_keeps_running(self):
+        monitor = module.ConvergenceMonitor(window=25, threshold=1e-3, min_iterations=50)
+        self.assertFalse(any(monitor.add(-float(i)) for i in range(200)))
+
+    def test_stops_once_improvement_falls_below_threshold(self):
+        monitor = module.ConvergenceMonitor(window=10, threshold=1e-2, min_iterations=20)
+        ## Improves quickly, then levels off at -1
+        metrics = [-1 + 0.5**i for i in range(100)]
+        stopped = next(i for i, m in enumerate(metrics) if monitor.add(m))
+        self.assertGreaterEqual(stopped, 19)
+        self.assertLess(stopped, 40)
+
+    def test_worsening_metric_counts_as_converged(self):
+        monitor = module.ConvergenceMonitor(window=10, min_iterations=20)
+        self.assertTrue([monitor.add(float(i)) for i in range(20)][-1])
+
+    def test_reset(self):
+        monitor = module.ConvergenceMonitor(window=10, min_iterations=20)
+        for _ in range(20): monitor.add(1.0)
+        monitor.reset()
+        self.assertFalse(monitor.add(1.0))
+
+
+class ElastixParametersToMatrixTest(TemporaryDirectoryTestCase):
+    points = [(0, 0, 0), (10, -5, 3), (-2.5, 7, 11)]
+
+    def assertMapsLike(self, matrix, transform_point):
+        for p in self.points:
+            np.testing.assert_allclose(matrix.dot(list(p) + [1])[:3], transform_point(p), atol=1e-9)
+
+    def write_euler(self, name, angles, translation, center, zyx=False, initial="NoInitialTransform"):
+        return write_file(self.directory, name, "\n".join([
+            '(Transform "EulerTransform")',
+            '(NumberOfParameters 6)',
+            '(TransformParameters %s)' % ' '.join(repr(v) for v in list(angles) + list(translation)),
+            '(InitialTransformParametersFileName "%s")' % initial,
+            '(HowToCombineTransforms "Compose")',
+            '(CenterOfRotationPoint %s)' % ' '.join(repr(v) for v in center),
+            '(ComputeZYX "%s")' % ("true" if zyx else "false"),
+        ]) + "\n")
+
+    def test_euler(self):
+        for zyx in (False, True):
+            path = self.write_euler("euler.txt", (0.1, -0.2, 0.3), (1.5, -2.0, 3.0), (10.0, 20.0, 30.0), zyx=zyx)
+            euler = sitk.Euler3DTransform((10.0, 20.0, 30.0), 0.1, -0.2, 0.3, (1.5, -2.0, 3.0))
+            euler.SetComputeZYX(zyx)
+            self.assertMapsLike(Logic.elastix_parameters_to_matrix(path), euler.TransformPoint)
+
+    def test_affine(self):
+        linear = [1.1, 0.1, -0.05, 0.02, 0.9, 0.1, 0.0, -0.1, 1.05]
+        path = write_file(self.directory, "affine.txt", "\n".join([
+            '(Transform "AffineTransform")',
+            '(TransformParameters %s 4.0 -3.0 2.0)' % ' '.join(repr(v) for v in linear),
+            '(InitialTransformParametersFileName "NoInitialTransform")',
+            '(CenterOfRotationPoint 5.0 -5.0 1.0)',
+        ]) + "\n")
+        affine = sitk.AffineTransform(linear, (4.0, -3.0, 2.0), (5.0, -5.0, 1.0))
+        self.assertMapsLike(Logic.elastix_parameters_to_matrix(path), affine.TransformPoint)
+
+    def test_initial_transform_is_applied_first(self):
+        ## As written by a level registered with -t0 pointing at the previous level's result
+        first = self.write_euler("TransformParameters.0.txt", (0.05, 0.0, -0.1), (1.0, 2.0, 3.0), (0.0, 0.0, 0.0))
+        second = self.write_euler("TransformParameters.1.txt", (0.0, 0.2, 0.0), (-1.0, 0.5, 0.0), (4.0, 4.0, 4.0), initial=first)
+        ## A relative name is resolved next to the file that refers to it
+        third = self.write_euler("TransformParameters.2.txt", (0.1, 0.0, 0.0), (0.0, 0.0, 2.0), (1.0, 2.0, 3.0), initial="TransformParameters.1.txt")
+        transforms = [sitk.Euler3DTransform((0.0, 0.0, 0.0), 0.05, 0.0, -0.1, (1.0, 2.0, 3.0)),
+                      sitk.Euler3DTransform((4.0, 4.0, 4.0), 0.0, 0.2, 0.0, (-1.0, 0.5, 0.0)),
+                      sitk.Euler3DTransform((1.0, 2.0, 3.0), 0.1, 0.0, 0.0, (0.0, 0.0, 2.0))]
+
+        def chain(p, n):
+            for t in transforms[:n]: p = t.TransformPoint(p)
+            return p
+        self.assertMapsLike(Logic.elastix_parameters_to_matrix(second), lambda p: chain(p, 2))
+        self.assertMapsLike(Logic.elastix_parameters_to_matrix(third), lambda p: chain(p, 3))
+
+    def test_unsupported_transform(self):
+        path = write_file(self.directory, "bspline.txt", '(Transform "BSplineTransform")\n(TransformParameters 0 0 0)\n')
+        self.assertRaises(ValueError, Logic.elastix_parameters_to_matrix, path)
+
+
+class LastCompleteTransformTest(TemporaryDirectoryTestCase):
+    transform = "\n".join([
+        '(Transform "EulerTransform")',
+        '(NumberOfParameters 6)',
+        '(TransformParameters 0.1 -0.2 0.3 1.5 -2.0 3.0)',
+        '(InitialTransformParametersFileName "NoInitialTransform")',
+        '(CenterOfRotationPoint 10.0 20.0 30.0)',
+        '(ComputeZYX "false")',
+    ]) + "\n"
+
+    def write(self, iteration, text):
+        return write_file(self.directory, "TransformParameters.0.R0.It%07d.txt" % iteration, text)
+
+    def test_skips_the_file_being_written(self):
+        self.write(8, self.transform)
+        previous = self.write(9, self.transform)
+        ## Killed while writing: the center of rotation is missing
+        self.write(10, self.transform[:self.transform.index("(CenterOfRotationPoint")])
+        self.assertEqual(module.ElastixRegistrationJob.last_complete_transform(self.directory), previous)
+
+    def test_single_file(self):
+        path = self.write(0, self.transform)
+        self.assertEqual(module.ElastixRegistrationJob.last_complete_transform(self.directory), path)
+        self.write(0, self.transform[:self.transform.index("(CenterOfRotationPoint")])
+        self.assertIsNone(module.ElastixRegistrationJob.last_complete_transform(self.directory))
+        self.write(0, self.transform[:self.transform.index(" 3.0)")])
+        self.assertIsNone(module.ElastixRegistrationJob.last_complete_transform(self.directory))
+
+    def test_nothing_written(self):
+        write_file(self.directory, "TransformParameters.0.txt", self.transform)
+        self.assertIsNone(module.ElastixRegistrationJob.last_complete_transform(self.directory))
+
+
+class SlabResampleTest(unittest.TestCase):
+    """The slab-parallel resampling must give the same voxels as a single ``sitk.Resample`` of the whole image."""
+    def setUp(self):
+        values = np.random.RandomState(0).rand(30, 36, 40).astype(np.float32)
+        self.image = sitk.GetImageFromArray(values)
+        self.image.SetSpacing((0.5, 0.6, 0.7))
+        self.image.SetOrigin((-3.0, 2.0, 5.0))
+
+    def resample_whole(self, image, spacing, interpolation):
+        size = Logic.get_resample_size(image, spacing)
+        return sitk.Resample(image, size, sitk.Transform(), interpolation, image.GetOrigin(), spacing, image.GetDirection(), 0, image.GetPixelID())
+
+    def assertResamplesLike(self, image, spacing, interpolation, tolerance):
+        ## Small slabs, so that most of them border on others rather than on the image's edge
+        slabs = Logic.resample_image(image, spacing, interpolation, threads=3, slab_voxels=2000)
+        whole = self.resample_whole(image, spacing, interpolation)
+        self.assertEqual(slabs.GetSize(), whole.GetSize())
+        np.testing.assert_allclose(slabs.GetOrigin(), whole.GetOrigin())
+        np.testing.assert_allclose(slabs.GetSpacing(), whole.GetSpacing())
+        np.testing.assert_allclose(sitk.GetArrayViewFromImage(slabs), sitk.GetArrayViewFromImage(whole), rtol=0, atol=tolerance)
+
+    def test_interpolators(self):
+        for interpolation, tolerance in ((sitk.sitkNearestNeighbor, 0), (sitk.sitkLinear, 1e-6), (sitk.sitkGaussian, 1e-5),
+                                         (sitk.sitkHammingWindowedSinc, 1e-5), (sitk.sitkBSpline, 1e-3)):
+            with self.subTest(interpolation=interpolation):
+                self.assertResamplesLike(self.image, (0.4, 0.45, 0.5), interpolation, tolerance)
+
+    def test_downsampling(self):
+        self.assertResamplesLike(self.image, (1.1, 1.3, 0.9), sitk.sitkGaussian, 1e-5)
+
+    def test_oblique_direction(self):
+        image = sitk.Image(self.image)
+        image.SetDirection(sitk.VersorTransform((0.3, 0.2, 1.0), 0.4).GetMatrix())
+        self.assertResamplesLike(image, (0.4, 0.45, 0.5), sitk.sitkLinear, 1e-6)
+
+    def test_gaussian_margin_covers_its_support(self):
+        ## SimpleITK's Gaussian interpolator reaches 4 sigmas of 0.8 mm, i.e. 3.2 mm
+        margin = Logic.get_interpolation_margin(sitk.sitkGaussian, (0.02, 0.05, 1.0))
+        self.assertGreaterEqual(margin[0], 3.2/0.02)
+        self.assertGreaterEqual(margin[1], 3.2/0.05)
+        self.assertGreaterEqual(margin[2], 4)
+        self.assertEqual(Logic.get_interpolation_margin(sitk.sitkNearestNeighbor, (0.02, 0.05, 1.0)), [0, 0, 0])
+
+    def test_output_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = Logic.resample_image(self.image, (0.4, 0.45, 0.5), sitk.sitkLinear, threads=2, slab_voxels=2000,
+                                        output_path=os.path.join(directory, "out.nrrd"))
+            written = sitk.ReadImage(path)
+            whole = self.resample_whole(self.image, (0.4, 0.45, 0.5), sitk.sitkLinear)
+            np.testing.assert_allclose(written.GetSpacing(), whole.GetSpacing())
+            np.testing.assert_allclose(written.GetOrigin(), whole.GetOrigin())
+            np.testing.assert_allclose(sitk.GetArrayViewFromImage(written), sitk.GetArrayViewFromImage(whole), rtol=0, atol=1e-6)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class TransformedGridResampleTest(unittest.TestCase):
+    """Resampling through a rigid transform onto a cropped grid, as for a crop with the registration applied, must
+    match ``sitk.Resample`` with the same transform and grid."""
+    def setUp(self):
+        values = np.random.RandomState(1).rand(32, 30, 28).astype(np.float32)
+        self.image = sitk.GetImageFromArray(values)
+        self.image.SetSpacing((0.5, 0.5, 0.6))
+        self.image.SetOrigin((1.0, -2.0, 0.5))
+        self.transform = sitk.Euler3DTransform((7.0, 5.0, 10.0), 0.1, -0.15, 0.2, (0.8, -0.5, 1.2))
+
+    def assertResamplesLike(self, origin, spacing, direction, size, interpolation, tolerance):
+        grid = Logic.resample_to_grid(self.image, origin, spacing, direction, size, interpolation, transform=self.transform,
+                                      default_value=-5, threads=3, slab_voxels=1500)
+        whole = sitk.Resample(self.image, size, self.transform, interpolation, origin, spacing, direction, -5, self.image.GetPixelID())
+        np.testing.assert_allclose(grid.GetOrigin(), origin)
+        np.testing.assert_allclose(grid.GetDirection(), direction)
+        np.testing.assert_allclose(sitk.GetArrayViewFromImage(grid), sitk.GetArrayViewFromImage(whole), rtol=0, atol=tolerance)
+
+    def test_crop_inside(self):
+        for interpolation, tolerance in ((sitk.sitkLinear, 1e-6), (sitk.sitkBSpline, 1e-3)):
+            with self.subTest(interpolation=interpolation):
+                self.assertResamplesLike((3.0, 2.0, 4.0), (0.5, 0.5, 0.6), (1, 0, 0, 0, 1, 0, 0, 0, 1), (14, 12, 16), interpolation, tolerance)
+
+    def test_grid_partly_outside(self):
+        ## Voxels mapped outside the input get the default value, whole slabs included
+        self.assertResamplesLike((-6.0, -8.0, -12.0), (0.7, 0.7, 0.7), (1, 0, 0, 0, 1, 0, 0, 0, 1), (30, 30, 40), sitk.sitkLinear, 1e-6)
+
+    def test_oblique_grid(self):
+        direction = sitk.VersorTransform((1.0, -0.5, 0.2), 0.5).GetMatrix()
+        self.assertResamplesLike((4.0, 3.0, 5.0), (0.4, 0.4, 0.4), direction, (16, 18, 20), sitk.sitkLinear, 1e-6)
+
+
+class DiskCacheTest(TemporaryDirectoryTestCase):
+    def put(self, cache, key, size):
+        return cache.put(key, lambda directory: write_file(directory, "data", "x"*size))
+
+    def age(self, cache, key, seconds):
+        t = os.path.getmtime(cache.entry_path(key)) - seconds
+        os.utime(cache.entry_path(key), (t, t))
+
+    def test_put_and_get(self):
+        cache = module.DiskCache(self.directory, 1000)
+        self.assertIsNone(cache.get("a"))
+        path = self.put(cache, "a", 10)
+        self.assertEqual(cache.get("a"), path)
+        with open(os.path.join(path, "data")) as f:
+            self.assertEqual(f.read(), "x"*10)
+
+    def test_evicts_least_recently_used(self):
+        cache = module.DiskCache(self.directory, 250)
+        self.put(cache, "a", 100)
+        self.put(cache, "b", 100)
+        self.age(cache, "a", 20)
+        self.age(cache, "b", 10)
+        ## Using "a" makes "b" the least recently used
+        cache.get("a")
+        self.put(cache, "c", 100)
+        self.assertEqual(sorted(key for key, _, _ in cache.entries()), ["a", "c"])
+        self.assertLessEqual(cache.size(), 250)
+
+    def test_replaces_an_entry(self):
+        cache = module.DiskCache(self.directory, 1000)
+        self.put(cache, "a", 100)
+        self.put(cache, "a", 50)
+        self.assertEqual(cache.entries()[0][:2], ("a", 50))
+
+    def test_refuses_an_entry_larger_than_the_cache(self):
+        cache = module.DiskCache(self.directory, 250)
+        self.put(cache, "a", 100)
+        self.assertIsNone(self.put(cache, "big", 300))
+        self.assertIsNone(cache.get("big"))
+        ## Nothing else was evicted to make room, and nothing was left behind
+        self.assertEqual([key for key, _, _ in cache.entries()], ["a"])
+        self.assertEqual(os.listdir(self.directory), ["a"])
+
+    def test_failed_write_leaves_nothing(self):
+        cache = module.DiskCache(self.directory, 1000)
+        def write(directory):
+            write_file(directory, "data", "partial")
+            raise IOError("disk full")
+        self.assertRaises(IOError, cache.put, "a", write)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+@unittest.skipIf(getattr(slicer, "mrmlScene", None) is None, "needs the Slicer application to create volumes")
+class InferenceKeyTest(unittest.TestCase):
+    def setUp(self):
+        slicer.mrmlScene.Clear(0)
+        self.model = {"id": "ABLTempSeg", "version": "1.0"}
+
+    def volume(self, value=0):
+        voxels = np.zeros((4, 5, 6), dtype=np.int16)
+        voxels[1, 2, 3] = value
+        return slicer.util.addVolumeFromArray(voxels)
+
+    def model_config(self, node, **params):
+        return {
+            "inputs": {"input_vol": {"value": node, "status": "required"}},
+            "params": dict({"threshold": 0.5}, **params),
+            "outputs": {"output_seg": {"value": None, "enabled": True, "smoothing": {"enabled": True, "factor": 0.5}}},
+        }
+
+    def key(self, model_config, model=None):
+        return Logic.compute_inference_key(model or self.model, model_config)
+
+    def test_depends_on_voxels_not_on_the_node(self):
+        node = self.volume()
+        self.assertEqual(self.key(self.model_config(node)), self.key(self.model_config(self.volume())))
+        self.assertNotEqual(self.key(self.model_config(node)), self.key(self.model_config(self.volume(1))))
+
+    def test_depends_on_geometry(self):
+        node, moved = self.volume(), self.volume()
+        moved.SetOrigin(1, 0, 0)
+        self.assertNotEqual(self.key(self.model_config(node)), self.key(self.model_config(moved)))
+
+    def test_depends_on_model_and_parameters(self):
+        node = self.volume()
+        key = self.key(self.model_config(node))
+        self.assertNotEqual(key, self.key(self.model_config(node, threshold=0.6)))
+        self.assertNotEqual(key, self.key(self.model_config(node), dict(self.model, version="1.1")))
+
+    def test_ignores_outputs_and_smoothing(self):
+        node = self.volume()
+        model_config = self.model_config(node)
+        key = self.key(model_config)
+        model_config["outputs"]["output_seg"]["value"] = self.volume()
+        model_config["outputs"]["output_seg"]["smoothing"]["factor"] = 0.9
+        self.assertEqual(key, self.key(model_config))
+
+
+class DroppingReader(io.BytesIO):
+    """A response body whose connection drops after ``limit`` bytes."""
+    def __init__(self, data, limit=None):
+        super().__init__(data)
+        self.limit = limit
+
+    def read(self, n=-1):
+        if self.limit is not None and self.tell() >= self.limit: raise ConnectionResetError("connection dropped")
+        if self.limit is not None and (n is None or n < 0 or self.tell() + n > self.limit): n = self.limit - self.tell()
+        return super().read(n)
+
+
+class FakeServer(requests.adapters.BaseAdapter):
+    """Serves one file with byte ranges, dropping the connection after ``drop`` bytes of the first response."""
+    def __init__(self, data, drop=None, digest=None):
+        super().__init__()
+        self.data = data
+        self.drop = drop
+        self.digest = digest or hashlib.sha256(data).digest()
+        self.requests = []
+        self.uploaded = None
+
+    def send(self, request, stream=False, **kwargs):
+        self.requests.append(request)
+        if request.method == "PUT":
+            self.uploaded = request.body.read()
+            return self.respond(request, 204, b"", {})
+        headers = {"Content-Length": str(len(self.data)), "Accept-Ranges": "bytes", "ETag": '"1"', "Digest": "sha-256=" + base64.b64encode(self.digest).decode()}
+        if "Range" in request.headers:
+            offset = int(request.headers["Range"][6:-1])
+            headers["Content-Length"] = str(len(self.data) - offset)
+            return self.respond(request, 206, self.data[offset:], headers)
+        drop, self.drop = self.drop, None
+        return self.respond(request, 200, self.data, headers, drop)
+
+    def respond(self, request, status, data, headers, drop=None):
+        raw = urllib3.HTTPResponse(body=DroppingReader(data, drop), headers=headers, status=status, preload_content=False, enforce_content_length=False)
+        return requests.adapters.HTTPAdapter().build_response(request, raw)
+
+    def close(self):
+        pass
+
+
+class Upload:
+    """A sized file-like body without ``fileno``, like ABLInfer's upload wrapper."""
+    def __init__(self, data):
+        self.fp = io.BytesIO(data)
+
+    def read(self, n=-1):
+        return self.fp.read(n)
+
+    def tell(self):
+        return self.fp.tell()
+
+    def seek(self, n, whence=0):
+        return self.fp.seek(n, whence)
+
+    def __len__(self):
+        return len(self.fp.getvalue())
+
+
+class TransferAdapterTest(unittest.TestCase):
+    def session(self, server):
+        adapter = module.TransferAdapter(server, chunk_size=1000)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        return session, adapter
+
+    def test_resumes_a_streamed_download(self):
+        data = os.urandom(10000)
+        server = FakeServer(data, drop=3500)
+        session, adapter = self.session(server)
+        r = session.get("http://server/output", stream=True)
+        self.assertEqual(b"".join(r.iter_content(1000)), data)
+        self.assertEqual(server.requests[1].headers["Range"], "bytes=3000-")
+        self.assertEqual(adapter.throughput("download")[0], len(data))
+
+    def test_resumes_a_download(self):
+        data = os.urandom(10000)
+        server = FakeServer(data, drop=3500)
+        session, adapter = self.session(server)
+        self.assertEqual(session.get("http://server/output").content, data)
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(adapter.throughput("download")[0], len(data))
+
+    def test_checks_a_streamed_download(self):
+        server = FakeServer(os.urandom(5000), digest=b"\0"*32)
+        session, adapter = self.session(server)
+        r = session.get("http://server/output", stream=True)
+        self.assertRaises(Exception, lambda: b"".join(r.iter_content(1000)))
+        self.assertIsNone(adapter.throughput("download"))
+
+    def test_times_a_sized_upload(self):
+        data = os.urandom(5000)
+        server = FakeServer(b"")
+        session, adapter = self.session(server)
+        session.put("http://server/input", data=Upload(data))
+        self.assertEqual(server.uploaded, data)
+        self.assertEqual(adapter.throughput("upload")[0], len(data))
+
+
+class ModelServer(requests.adapters.BaseAdapter):
+    """Serves a model descriptor, answering a matching ``If-None-Match`` with 304."""
+    def __init__(self, etag=None):
+        super().__init__()
+        self.etag = etag
+        self.requests = []
+
+    def send(self, request, stream=False, **kwargs):
+        self.requests.append(request)
+        headers = {"ETag": self.etag} if self.etag else {}
+        if self.etag is not None and request.headers.get("If-None-Match") == self.etag: status, body = 304, b""
+        else: status, body = 200, b'{"data": {"id": "ABLTempSeg", "version": "1.0"}}'
+        raw = urllib3.HTTPResponse(body=io.BytesIO(body), headers=headers, status=status, preload_content=False)
+        return requests.adapters.HTTPAdapter().build_response(request, raw)
+
+    def close(self):
+        pass
+
+
+class RemoteClientTest(unittest.TestCase):
+    def client(self, server):
+        client = module.RemoteClient("http://server", ttl=0)
+        client.session.mount("http://", server)
+        return client
+
+    def test_one_request_per_fetch(self):
+        server = ModelServer()
+        client = self.client(server)
+        self.assertEqual(client.get_model("ABLTempSeg")["version"], "1.0")
+        self.assertEqual(client.get_model("ABLTempSeg")["version"], "1.0")
+        self.assertEqual([r.method for r in server.requests], ["GET", "GET"])
+        self.assertNotIn("If-None-Match", server.requests[1].headers)
+
+    def test_revalidates_with_the_etag(self):
+        server = ModelServer('"1"')
+        client = self.client(server)
+        model = client.get_model("ABLTempSeg")
+        self.assertIs(client.get_model("ABLTempSeg"), model)
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(server.requests[1].headers["If-None-Match"], '"1"')
+
+    def test_uses_the_cache_within_the_ttl(self):
+        server = ModelServer()
+        client = self.client(server)
+        client.ttl = 600
+        client.get_model("ABLTempSeg")
+        client.get_model("ABLTempSeg")
+        self.assertEqual(len(server.requests), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
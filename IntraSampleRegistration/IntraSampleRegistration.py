@@ -1,7 +1,9 @@
+import os
+import time
+
 import qt
 import slicer
 import ABLTemporalBoneSegmentationModule
-import Elastix
 from slicer.ScriptedLoadableModule import *
 
 
@@ -97,8 +99,8 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
     volumePairs = []
 
     # Registration logic nodes
-    elastixLogic = Elastix.ElastixLogic()
-    brainsCliLogic = None
+    elastixLogic = None
+    batch = None
 
     # UI members -------------- (in order of appearance)
     processTable = None
@@ -107,6 +109,7 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
     volumePairTools = None
     addButton = None
     removeButton = None
+    concurrencyBox = None
     executeButton = None
     saveButton = None
     progressBox = None
@@ -115,6 +118,7 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
     progressBar = None
     cancelButton = None
     finishButton = None
+    progressBus = None
 
     # initialization ------------------------------------------------------------------------------
     def __init__(self, parent):
@@ -129,6 +133,10 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
         self.layout.addWidget(self.build_progress())
         self.click_add_volume_pair()
 
+    def cleanup(self):
+        if self.batch is not None: self.batch.cancel()
+        ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.clear_elastix_input_store()
+
     def build_process_setup(self):
         self.processTable = qt.QTableWidget(0, 1)
         self.processTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
@@ -190,6 +198,13 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
         self.removeButton.setFixedSize(90, 36)
         self.removeButton.enabled = False
         self.removeButton.connect('clicked(bool)', self.click_remove_volume_pair)
+        self.concurrencyBox = qt.QSpinBox()
+        self.concurrencyBox.setMinimum(1)
+        self.concurrencyBox.setMaximum(max(1, os.cpu_count() or 1))
+        self.concurrencyBox.value = min(2, self.concurrencyBox.maximum)
+        self.concurrencyBox.setPrefix("Parallel: ")
+        self.concurrencyBox.setFixedHeight(36)
+        self.concurrencyBox.setToolTip("Number of volume pairs registered at the same time, each in its own Elastix/BRAINS process.")
         self.executeButton = qt.QPushButton("Execute")
         self.executeButton.setFixedHeight(36)
         self.executeButton.enabled = False
@@ -203,6 +218,7 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
         layout = qt.QHBoxLayout(self.volumePairTools)
         layout.addWidget(self.addButton)
         layout.addWidget(self.removeButton)
+        layout.addWidget(self.concurrencyBox)
         layout.addWidget(self.executeButton)
         layout.addWidget(self.saveButton)
         layout.setContentsMargins(10, 0, 10, 20)
@@ -223,6 +239,7 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
         self.finishButton.visible = False
         self.finishButton.connect('clicked(bool)', self.click_finish)
         self.finishButton.setFixedHeight(36)
+        self.progressBus = ABLTemporalBoneSegmentationModule.ProgressBus(self.refresh_progress, echo=True)
         # FRAME
         self.progressBox = qt.QFrame()
         self.progressBox.hide()
@@ -289,6 +306,12 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
             if f is None or m is None: pair.status = PairStatus.LOADING
             elif pair.status is not PairStatus.COMPLETE: pair.status = PairStatus.READY
 
+    def update_row_statuses(self):
+        for i, pair in enumerate(self.volumePairs):
+            item = self.volumeTable.item(i, 2)
+            text = pair.StatusString()
+            if item is not None and item.text() != text: item.setText(text)
+
     def update_row(self, pair, i):
         self.volumeTable.setCellWidget(i, 0, pair.fixed)
         self.volumeTable.setCellWidget(i, 1, pair.moving)
@@ -305,17 +328,24 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
         self.update_volume_pair_tools()
 
     def update_progress(self, text=None, current_registration_step=None, progress=None):
-        if text is not None:
-            print(text)
+        state = {}
+        if current_registration_step is not None: state['current_registration_step'] = current_registration_step
+        if progress is not None: state['progress'] = progress
+        self.progressBus.post(text, **state)
+
+    def refresh_progress(self, lines, state):
+        previous = self.state
+        current_registration_step, progress = state.get('current_registration_step'), state.get('progress')
+        if lines:
+            text = lines[-1]
             self.currentProgressLabel.text = 'Status: ' + ((text[:60] + '..') if len(text) > 60 else text)
-            if progress is None: progress = ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.process_rigid_progress(text)
 
         if progress is not None:
             self.progressBar.value = progress
-            executed = len([p for p in self.volumePairs if p.status in [PairStatus.EXECUTING, PairStatus.COMPLETE]])
+            executed = len([p for p in self.volumePairs if p.status in [PairStatus.EXECUTING, PairStatus.COMPLETE, PairStatus.FAILED]])
             total = len([p for p in self.volumePairs if p.status == PairStatus.PENDING]) + executed
             self.progressBar.setFormat(str(progress) + '% (' + str(executed) + ' of ' + str(total) + ')')
-            if progress is 100:
+            if progress == 100:
                 self.state = IntraSampleRegistrationState.FINISHED
         if current_registration_step is not None and self.state is not IntraSampleRegistrationState.FINISHED:
             registration = None
@@ -325,8 +355,9 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
         elif self.state is IntraSampleRegistrationState.FINISHED:
             self.currentlyRunningLabel.text = 'Execution complete...'
 
-        self.update_all()
-        slicer.app.processEvents()
+        ## Only the status column changes while running; everything else only when the state does
+        if self.state is previous: self.update_row_statuses()
+        else: self.update_all()
 
     # button actions --------------------------------------
     def click_add_registration_step(self, process):
@@ -363,11 +394,20 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
             pair.disable()
         self.update_all()
         # execute
-        IntraSampleRegistrationLogic().execute_batch(self.elastixLogic, readyPairs, self.registrationSteps, self.update_progress)
+        self.elastixLogic = self.elastixLogic or ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.get_elastix_logic()
+        self.batch = IntraSampleRegistrationLogic().execute_batch(self.elastixLogic, readyPairs, self.registrationSteps, self.update_progress,
+                                                                  max_workers=self.concurrencyBox.value, on_finished=self.finish_batch)
+
+    def finish_batch(self, batch):
+        self.progressBus.flush()
+        minutes = batch.elapsed / 60.0
+        self.currentlyRunningLabel.text = 'Execution complete: {0} of {1} pair(s) in {2:.1f} min ({3:.1f} pairs/hour)'.format(batch.completed, batch.total, minutes, batch.throughput())
+        self.batch = None
 
     def click_cancel(self):
-        ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.attempt_abort_rigid_registration(self.elastixLogic)
-        if self.brainsCliLogic is not None: self.brainsCliLogic.Cancel()
+        if self.batch is not None: self.batch.cancel()
+        self.batch = None
+        self.progressBus.flush()
         self.click_finish()
 
     def click_finish(self):
@@ -380,41 +420,185 @@ class IntraSampleRegistrationWidget(ScriptedLoadableModuleWidget):
             ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.open_save_node_dialog(self.volumePairs[i.row()].moving.currentNode())
 
 
+class PairTask:
+    """The registration steps of a single pair, run one after another without blocking.
+
+    The step transforms are composed in a :class:`TransformChain` rather than hardened one by one;
+    the output volume keeps them until it is saved, cropped or used for inference.
+    """
+    def __init__(self, elastix, pair, registration_steps, log_callback, threads=None):
+        self.elastix = elastix
+        self.pair = pair
+        self.steps = list(registration_steps)
+        self.stepCount = len(self.steps)
+        self.log_callback = log_callback
+        self.threads = threads
+        self.chain = None
+        self.outputNode = pair.moving.currentNode()
+        self.job = None
+        self.cliNode = None
+        self.transformNode = None
+
+    def start_next_step(self):
+        registration = self.steps.pop(0)
+        self.log_callback(current_registration_step=registration)
+        if self.chain is None:
+            self.chain = ABLTemporalBoneSegmentationModule.TransformChain(self.outputNode)
+            self.outputNode = self.chain.node
+        if registration is RegistrationType.CUSTOM_ELASTIX:
+            self.job = ABLTemporalBoneSegmentationModule.ElastixRegistrationJob(
+                elastix=self.elastix,
+                fixed_node=self.pair.fixed.currentNode(),
+                moving_node=self.chain.proxy(),
+                parameter_filenames=["Parameters_Rigid.txt"],
+                log_callback=lambda text: self.log_callback(text=text),
+                threads=self.threads,
+                cache=ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.get_transform_cache(),
+                input_store=ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.get_elastix_input_store(self.elastix)
+            ).start()
+        elif registration is RegistrationType.CUSTOM_BRAINS:
+            self.cliNode, self.transformNode = IntraSampleRegistrationLogic.start_brains_rigid_registration(
+                pair=self.pair,
+                moving_node=self.chain.proxy()
+            )
+
+    def poll(self):
+        """Advance the task; returns True while it still has work to do."""
+        if self.job is not None:
+            if self.job.poll(): return True
+            job, self.job = self.job, None
+            if job.status != ABLTemporalBoneSegmentationModule.JobStatus.COMPLETE: raise Exception(job.error or 'Elastix registration cancelled')
+            self.chain.append(job.transform_node, "_Elastix")
+        elif self.cliNode is not None:
+            if self.cliNode.IsBusy(): return True
+            cliNode, self.cliNode = self.cliNode, None
+            if cliNode.GetStatusString() != 'Completed': raise Exception('BRAINS registration ' + cliNode.GetStatusString().lower())
+            self.chain.append(self.transformNode, "_BRAINS")
+            slicer.mrmlScene.RemoveNode(cliNode)
+        if len(self.steps) == 0:
+            self.chain.remove_proxy()
+            self.log_callback(text=self.chain.describe())
+            return False
+        self.start_next_step()
+        return True
+
+    def fraction(self):
+        """Fraction of this pair's registration steps done, counting the Elastix step in progress by its iterations."""
+        active = self.job is not None or self.cliNode is not None
+        done = self.stepCount - len(self.steps) - (1 if active else 0)
+        if self.job is not None: done += self.job.progress/100.0
+        return done/max(1, self.stepCount)
+
+    def cancel(self):
+        if self.job is not None: self.job.cancel()
+        if self.cliNode is not None: self.cliNode.Cancel()
+        if self.chain is not None: self.chain.remove_proxy()
+        self.steps = []
+
+
+class BatchScheduler:
+    """Runs independent volume pairs concurrently in a bounded pool of registration processes.
+
+    Polling happens on the main thread from a timer, so the Slicer UI stays responsive while the
+    Elastix/BRAINS processes run in the background.
+    """
+    pollInterval = 200
+
+    def __init__(self, elastix, pairs, registration_steps, update_progress, max_workers=1, on_finished=None):
+        self.elastix = elastix
+        self.pending = list(pairs)
+        self.registrationSteps = registration_steps
+        self.update_progress = update_progress
+        self.maxWorkers = max(1, max_workers)
+        self.on_finished = on_finished
+        self.running = []
+        self.total = len(self.pending)
+        self.completed = 0
+        self.failed = 0
+        self.startTime = None
+        self.elapsed = None
+        self.timer = qt.QTimer()
+        self.timer.setInterval(self.pollInterval)
+        self.timer.connect('timeout()', self.poll)
+
+    def start(self):
+        self.startTime = time.time()
+        self.fill()
+        self.timer.start()
+        return self
+
+    def fill(self):
+        threads = max(1, (os.cpu_count() or 1) // self.maxWorkers)
+        while len(self.pending) > 0 and len(self.running) < self.maxWorkers:
+            pair = self.pending.pop(0)
+            pair.status = PairStatus.EXECUTING
+            task = PairTask(self.elastix, pair, self.registrationSteps, self.update_progress, threads=threads)
+            self.running.append(task)
+            try:
+                task.start_next_step()
+            except Exception as e:
+                self.finish_task(task, e)
+
+    def finish_task(self, task, error=None):
+        self.running.remove(task)
+        if error is None:
+            task.pair.moving.setCurrentNode(task.outputNode)
+            task.pair.status = PairStatus.COMPLETE
+            self.completed += 1
+        else:
+            task.pair.status = PairStatus.FAILED
+            self.failed += 1
+            self.update_progress(text='Error: {0}'.format(error))
+
+    def poll(self):
+        for task in list(self.running):
+            try:
+                if not task.poll(): self.finish_task(task)
+            except Exception as e:
+                task.cancel()
+                self.finish_task(task, e)
+        self.fill()
+        if len(self.running) == 0 and len(self.pending) == 0:
+            self.timer.stop()
+            self.elapsed = time.time() - self.startTime
+        self.update_progress(progress=self.progress())
+        if self.elapsed is not None and self.on_finished is not None: self.on_finished(self)
+
+    def progress(self):
+        if self.total == 0: return 100
+        ## Running pairs never count as fully done, so 100 is only reported once every pair has finished
+        running = sum(min(0.99, task.fraction()) for task in self.running)
+        return int(100 * (self.completed + self.failed + running) / self.total)
+
+    def throughput(self):
+        """Completed pairs per hour."""
+        elapsed = self.elapsed if self.elapsed is not None else time.time() - self.startTime
+        return 3600.0 * self.completed / max(elapsed, 1e-6)
+
+    def cancel(self):
+        self.timer.stop()
+        for task in self.running:
+            task.cancel()
+            task.pair.status = PairStatus.FAILED
+        for pair in self.pending: pair.status = PairStatus.READY
+        self.running, self.pending = [], []
+
+
 class IntraSampleRegistrationLogic(ScriptedLoadableModuleLogic):
     @staticmethod
-    def execute_batch(elastix, pairs, registration_steps, update_progress):
-        for pair in pairs:
-            pair.status = PairStatus.EXECUTING
-            outputNode = pair.moving.currentNode()
-            for registration in registration_steps:
-                update_progress(current_registration_step=registration)
-                if registration is RegistrationType.CUSTOM_ELASTIX:
-                    outputNode = ABLTemporalBoneSegmentationModule.ABLTemporalBoneSegmentationModuleLogic.apply_elastix_rigid_registration(
-                        elastix=elastix,
-                        atlas_node=pair.fixed.currentNode(),
-                        moving_node=outputNode,
-                        mask_node=None,
-                        log_callback=update_progress
-                    )
-                    update_progress(progress=100)
-                elif registration is RegistrationType.CUSTOM_BRAINS:
-                    outputNode = IntraSampleRegistrationLogic.apply_brains_rigid_registration(
-                        pair=pair,
-                        moving_node=outputNode,
-                        log_callback=update_progress
-                    )
-                    update_progress(progress=100)
-            pair.moving.setCurrentNode(outputNode)
-            pair.status = PairStatus.COMPLETE
-            update_progress()
+    def execute_batch(elastix, pairs, registration_steps, update_progress, max_workers=1, on_finished=None):
+        """Start registering the given pairs, at most ``max_workers`` at a time.
+
+        :returns: The running :class:`BatchScheduler`.
+        """
+        return BatchScheduler(elastix, pairs, registration_steps, update_progress, max_workers=max_workers, on_finished=on_finished).start()
 
     @staticmethod
-    def apply_brains_rigid_registration(moving_node, pair, log_callback):
+    def start_brains_rigid_registration(moving_node, pair):
         transform_node = slicer.vtkMRMLTransformNode()
         transform_node.SetName(moving_node.GetName() + ' BRAINS transform')
         slicer.mrmlScene.AddNode(transform_node)
-        # TODO use runSync
-        slicer.cli.run(slicer.modules.brainsfit, None, {
+        cliNode = slicer.cli.run(slicer.modules.brainsfit, None, {
             'fixedVolume': pair.fixed.currentNode().GetID(),
             'movingVolume': moving_node.GetID(),
             'outputTransform': transform_node.GetID(),
@@ -430,12 +614,8 @@ class IntraSampleRegistrationLogic(ScriptedLoadableModuleLogic):
             'reproportionScale'     : 1.0,
             'relaxationFactor'      : 0.5,
             'translationScale'      : 1.0  # aka transform scale
-        }, wait_for_completion=True)
-        print('TRANSFORM GENERATED: '); print(transform_node)
-        moving_node.ApplyTransform(transform_node.GetTransformToParent())
-        moving_node.HardenTransform()
-        moving_node.SetName(moving_node.GetName() + "_BRAINS")
-        return moving_node
+        }, wait_for_completion=False)
+        return cliNode, transform_node
 
 
 class IntraSampleRegistrationTest(ScriptedLoadableModuleTest):
@@ -445,6 +625,14 @@ class IntraSampleRegistrationTest(ScriptedLoadableModuleTest):
     def runTest(self):
         self.setUp()
         self.test_IntraSampleRegistration1()
+        self.test_startup_budget()
+
+    def test_startup_budget(self):
+        self.delayDisplay("Measuring the module import time")
+        elapsed, loaded = ABLTemporalBoneSegmentationModule.measure_module_import("IntraSampleRegistration", paths=[os.path.dirname(os.path.abspath(__file__))])
+        self.assertEqual(loaded, [], "Imported on the startup path: " + ", ".join(loaded))
+        self.assertLess(elapsed, ABLTemporalBoneSegmentationModule.startupBudget, "Importing took %.3f s" % elapsed)
+        self.delayDisplay("Imported in %.3f s (budget %.3f s)" % (elapsed, ABLTemporalBoneSegmentationModule.startupBudget))
 
     def test_IntraSampleRegistration1(self):
         self.delayDisplay("Starting the test")